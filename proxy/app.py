@@ -17,15 +17,31 @@ async def client_session_ctx(app) -> NoReturn:
     await app["client_session"].close()
 
 
+async def upstream_ctx(app) -> NoReturn:
+    await app["upstream"].open()
+    yield
+    await app["upstream"].close()
+
+
 async def create_app() -> web.Application:
     # load registered hooks
     from proxy import hooks  # noqa: F401
+    from proxy.conf import settings
+    from proxy.dispatch import post_upload_queue_ctx
     from proxy.handlers import routes  # avoid circular import
+    from proxy.resilience import Upstream
+    from proxy.singleflight import SingleFlight
 
     app = web.Application()
     app.add_routes(routes)
+    app["upstream"] = Upstream.from_settings()
+
+    if settings.GET_COALESCING_ENABLED:
+        app["single_flight"] = SingleFlight()
 
     app.cleanup_ctx.append(client_session_ctx)
+    app.cleanup_ctx.append(upstream_ctx)
+    app.cleanup_ctx.append(post_upload_queue_ctx)
 
     return app
 
@@ -0,0 +1,126 @@
+"""
+Acting for clients whose credentials are known to the proxy.
+
+Some requests have to be changed before they are passed upstream: aws-chunked
+uploads are decoded, encrypted objects are copied by the proxy. The client's
+signature doesn't cover the changed request, so it is signed again with the
+client's credentials from `PROXY_CLIENT_CREDENTIALS`, but only after the client's
+own signature has been verified with them.
+"""
+from typing import Iterable, List, NamedTuple, Optional
+
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from proxy import sigv4
+from proxy.conf import settings
+
+
+class AuthError(Exception):
+    def __init__(self, status: int, reason: str) -> None:
+        super().__init__(reason)
+        self.status = status
+
+
+class Credentials(NamedTuple):
+    access_key: str
+    secret: str
+    region: str
+    service: str = "s3"
+
+
+def is_signed(request: web.Request) -> bool:
+    """Return whether `request` is signed, in a header or as a presigned URL."""
+    return "Authorization" in request.headers or "X-Amz-Signature" in request.query
+
+
+def unsigned(request: web.Request, names: Iterable[str]) -> List[str]:
+    """
+    Return those of the header `names` the client didn't sign, in lower case.
+
+    They can be changed without invalidating the signature. If it isn't known what
+    the client signed, none of them are taken as unsigned.
+    """
+    names = [name.lower() for name in names]
+    if not is_signed(request):
+        return names
+    credential = sigv4.parse_authorization(request.headers.get("Authorization"))
+    if credential is not None:
+        signed = credential.signed_headers
+    elif "Authorization" not in request.headers:
+        signed = request.query.get("X-Amz-SignedHeaders", "").lower()
+    else:
+        return []
+    signed = set(signed.split(";"))
+    return [name for name in names if name not in signed]
+
+
+def client_credentials(
+    request: web.Request,
+    *,
+    required: bool = True,
+) -> Optional[Credentials]:
+    """
+    Return the verified credentials of the client that signed `request`.
+
+    Returns None for anonymous requests, and for clients that aren't known to the
+    proxy unless `required`.
+
+    Raises
+    ------
+        AuthError: If the client isn't known to the proxy (501) or the signature
+                   doesn't match (403).
+
+    """
+    authorization = request.headers.get("Authorization")
+    if authorization is None:
+        return None
+    credential = sigv4.parse_authorization(authorization)
+    secret = (
+        settings.CLIENT_CREDENTIALS.get(credential.access_key) if credential else None
+    )
+    if secret is None:
+        if not required:
+            return None
+        msg = "Changing signed requests requires the client's credentials."
+        raise AuthError(web.HTTPNotImplemented.status_code, msg)
+    if not sigv4.verify_request(
+        request.method,
+        request.rel_url,
+        request.headers,
+        secret,
+    ):
+        msg = "The request signature does not match."
+        raise AuthError(web.HTTPForbidden.status_code, msg)
+    return Credentials(
+        credential.access_key,
+        secret,
+        credential.region,
+        credential.service,
+    )
+
+
+def resign(
+    request: web.Request,
+    credentials: Credentials,
+    url: URL,
+    headers: CIMultiDict,
+) -> URL:
+    """
+    Sign the changed upstream request for `request` in place of the client.
+
+    The headers the client signed are signed again if they are still there, as
+    well as those the proxy might have added. Returns the URL the request must be
+    sent to, encoded exactly like it was signed.
+    """
+    client = sigv4.parse_authorization(request.headers["Authorization"])
+    url = sigv4.signed_url(url)
+    sigv4.sign_request(
+        request.method,
+        url,
+        headers,
+        *credentials,
+        signed_headers=[*client.signed_headers.split(";"), "content-md5"],
+    )
+    return url
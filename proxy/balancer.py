@@ -0,0 +1,169 @@
+"""
+Client-side load balancing over several object store endpoints.
+
+Each endpoint has its own connection pool. Requests go to the endpoint with the
+least outstanding requests or, latency-aware, to the one with the lowest
+`latency * (outstanding + 1)`. Endpoints failing `max_failures` times in a row are
+ejected for `ejection_time` seconds, doubling with every consecutive ejection.
+After that they are re-admitted and a single successful request makes them
+healthy again.
+"""
+import random
+import time
+from typing import Callable, Dict, Final, Iterable, List, Optional
+
+import aiohttp
+from yarl import URL
+
+LEAST_OUTSTANDING: Final = "least_outstanding"
+LATENCY: Final = "latency"
+STRATEGIES: Final = (LEAST_OUTSTANDING, LATENCY)
+
+# weight of the latest sample in the moving average of the latency
+LATENCY_DECAY: Final = 0.3
+MAX_EJECTION_TIME: Final = 300.0
+
+
+class Endpoint:
+    def __init__(self, url: URL) -> None:
+        self.url = url
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.url})"
+
+    def rebase(self, url) -> URL:
+        """Return `url` pointing to this endpoint."""
+        return (
+            URL(url)
+            .with_scheme(self.url.scheme)
+            .with_host(self.url.host)
+            .with_port(self.url.explicit_port)
+        )
+
+    def stats(self, now: float) -> Dict[str, object]:
+        return {
+            "url": str(self.url),
+            "healthy": self.ejected_until <= now,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejections": self.ejections,
+            "latency": self.latency,
+        }
+
+
+class Balancer:
+    """
+    Select upstream endpoints and track their health.
+
+    :param strategy: `"least_outstanding"` or `"latency"`.
+    :param max_failures: Consecutive failures after which an endpoint is ejected.
+    :param ejection_time: Seconds an endpoint is ejected for the first time.
+    """
+
+    def __init__(
+        self,
+        urls: Iterable[str],
+        strategy: str = LEAST_OUTSTANDING,
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+        pool_size: int = 100,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if strategy not in STRATEGIES:
+            msg = f"Unknown balancing strategy {strategy}, use one of {STRATEGIES}."
+            raise ValueError(msg)
+        self.endpoints = [Endpoint(URL(url)) for url in urls]
+        if not self.endpoints:
+            msg = "At least one endpoint is required."
+            raise ValueError(msg)
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.pool_size = pool_size
+        self.clock = clock
+
+    async def open(self) -> None:
+        for endpoint in self.endpoints:
+            endpoint.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+            )
+
+    async def close(self) -> None:
+        for endpoint in self.endpoints:
+            if endpoint.session is not None:
+                await endpoint.session.close()
+                endpoint.session = None
+
+    def _score(self, endpoint: Endpoint) -> float:
+        if self.strategy == LATENCY:
+            # endpoints without samples yet are tried first
+            return (endpoint.latency or 0.0) * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def select(self, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        """
+        Return the best healthy endpoint, preferring those not in `exclude`.
+
+        If all endpoints are ejected, the one re-admitted next is used rather than
+        failing the request.
+        """
+        now = self.clock()
+        healthy = [e for e in self.endpoints if e.ejected_until <= now]
+        if not healthy:
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        excluded = set(exclude)
+        candidates = [e for e in healthy if e not in excluded] or healthy
+        best = min(map(self._score, candidates))
+        return random.choice(  # noqa: S311
+            [e for e in candidates if self._score(e) == best],
+        )
+
+    def start(self, endpoint: Endpoint) -> None:
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+
+    def observe(self, endpoint: Endpoint, latency: float) -> None:
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += LATENCY_DECAY * (latency - endpoint.latency)
+
+    def finish(self, endpoint: Endpoint, *, failed: Optional[bool]) -> None:
+        """
+        Record the end of a request.
+
+        :param failed: Whether the request failed because of the endpoint. None for
+                       requests that were cancelled.
+        """
+        endpoint.outstanding -= 1
+        if failed is None:
+            return
+        if not failed:
+            endpoint.failures = 0
+            endpoint.ejections = 0
+            return
+
+        endpoint.errors += 1
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures:
+            ejection_time = min(
+                MAX_EJECTION_TIME,
+                self.ejection_time * 2**endpoint.ejections,
+            )
+            endpoint.ejections += 1
+            endpoint.ejected_until = self.clock() + ejection_time
+            # a re-admitted endpoint is ejected again by its next failure
+            endpoint.failures = self.max_failures - 1
+
+    def stats(self) -> List[Dict[str, object]]:
+        now = self.clock()
+        return [endpoint.stats(now) for endpoint in self.endpoints]
@@ -0,0 +1,134 @@
+"""
+Request body that hooks can consume while it is still being received.
+
+The handler feeds the body chunk by chunk from the event loop. Hooks that only
+need the first bytes of the payload are started as soon as those have arrived,
+hooks consuming the body as a stream iterate over it from their threads while it
+grows.
+"""
+import asyncio
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class BodyAbortedError(Exception):
+    """The body wasn't received completely."""
+
+
+class Body:
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._value: Optional[bytes] = None
+        self._eof = False
+        self._error: Optional[BaseException] = None
+        # wakes up threads iterating over the body
+        self._cond = threading.Condition()
+        # coroutines waiting for a number of bytes (or the end of the body)
+        self._waiters: List[Tuple[Optional[int], asyncio.Future]] = []
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Body":
+        body = cls()
+        body.feed(data)
+        body.close()
+        return body
+
+    def __len__(self) -> int:
+        return len(self._buf)
+
+    @property
+    def complete(self) -> bool:
+        return self._eof and self._error is None
+
+    def feed(self, data: bytes) -> None:
+        with self._cond:
+            self._buf += data
+            self._cond.notify_all()
+        self._wakeup()
+
+    def close(self) -> None:
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+        self._wakeup()
+
+    def abort(self, error: BaseException) -> None:
+        """Wake up all consumers with `error`, the body won't be completed."""
+        with self._cond:
+            self._error = error
+            self._eof = True
+            self._cond.notify_all()
+        self._wakeup()
+
+    def _ready(self, size: Optional[int]) -> bool:
+        return self._eof or (size is not None and len(self._buf) >= size)
+
+    def _wakeup(self) -> None:
+        waiting = []
+        for size, future in self._waiters:
+            if future.done():
+                continue
+            if self._error is not None:
+                future.set_exception(BodyAbortedError(str(self._error)))
+            elif self._ready(size):
+                future.set_result(None)
+            else:
+                waiting.append((size, future))
+        self._waiters = waiting
+
+    async def _wait(self, size: Optional[int]) -> None:
+        if self._error is not None:
+            raise BodyAbortedError(str(self._error))
+        if self._ready(size):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, future))
+        await future
+
+    async def prefix(self, size: int) -> bytes:
+        """Return the first `size` bytes once they have been received."""
+        await self._wait(size)
+        return bytes(self._buf[:size])
+
+    async def read(self) -> bytes:
+        """Return the whole body once it has been received."""
+        await self._wait(None)
+        return self.getvalue()
+
+    def getvalue(self) -> bytes:
+        """Return the complete body without waiting, it's only copied once."""
+        if not self.complete:
+            msg = "Body hasn't been received completely."
+            raise BodyAbortedError(msg)
+        if self._value is None:
+            self._value = bytes(self._buf)
+        return self._value
+
+    def getbuffer(self) -> memoryview:
+        """Return the complete body as a read-only view, without copying it."""
+        if not self.complete:
+            msg = "Body hasn't been received completely."
+            raise BodyAbortedError(msg)
+        return memoryview(self._buf).toreadonly()
+
+    def iter_chunks(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Iterate over the body, blocking until more data arrives.
+
+        Meant to be consumed from a thread, never from the event loop thread that
+        feeds the body (unless it is complete).
+        """
+        offset = 0
+        while True:
+            with self._cond:
+                while len(self._buf) <= offset and not self._eof:
+                    self._cond.wait()
+                if self._error is not None:
+                    raise BodyAbortedError(str(self._error))
+                if len(self._buf) <= offset:
+                    return
+                chunk = bytes(self._buf[offset : offset + chunk_size])
+            offset += len(chunk)
+            yield chunk
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from proxy.conf import settings
+
+Verdict = Tuple[bool, Any]
+
+
+class VerdictCache:
+    """
+    Bounded LRU cache of hook verdicts.
+
+    Entries are keyed by `(hook name, hook, hook version, content hash)` tuples,
+    so a known payload doesn't have to be scanned again. Entries expire after
+    `ttl` seconds. Bumping the version of a hook (e. g. when the scanner
+    signatures are updated) makes all previous verdicts of that hook
+    unreachable, `invalidate` drops them explicitly.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Verdict]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Verdict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < self.clock():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, verdict: Verdict) -> None:
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (self.clock() + self.ttl, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, hook_name: Optional[str] = None) -> None:
+        """Drop all verdicts, or only those of the hook with `hook_name`."""
+        if hook_name is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == hook_name]:
+            del self._entries[key]
+
+
+verdict_cache = VerdictCache(
+    maxsize=settings.VERDICT_CACHE_SIZE,
+    ttl=settings.VERDICT_CACHE_TTL,
+)
@@ -0,0 +1,180 @@
+import base64
+import hashlib
+import re
+import zlib
+from typing import Callable, Dict, Final, List, Mapping, NamedTuple, Optional, Tuple
+
+from multidict import CIMultiDict
+
+from proxy.conf import settings
+
+# S3 transmits additional checksums as `x-amz-checksum-<algorithm>` headers or
+# trailers, each carrying the base64 encoded digest.
+CHECKSUM_HEADER_PREFIX: Final = "x-amz-checksum-"
+
+# checksum of the plaintext stored as user metadata of encrypted objects
+PLAINTEXT_CHECKSUM_HEADER: Final = "X-Amz-Meta-Plaintext-Checksum"
+
+# request key passing the stored checksum from the handler to the decryption hook
+EXPECTED_CHECKSUM_KEY: Final = "expected_plaintext_checksum"
+
+# `x-amz-checksum-*` headers that don't carry a checksum
+CHECKSUM_PARAMETERS: Final = frozenset(["mode", "type"])
+
+_sha256_hex_re: Final = re.compile(r"^[0-9a-fA-F]{64}$")
+
+
+class Crc32:
+    """hashlib-like wrapper around `zlib.crc32`."""
+
+    name = "crc32"
+
+    def __init__(self, data: bytes = b"") -> None:
+        self._value = zlib.crc32(data)
+
+    def update(self, data: bytes) -> None:
+        self._value = zlib.crc32(data, self._value)
+
+    def digest(self) -> bytes:
+        return self._value.to_bytes(4, "big")
+
+
+ALGORITHMS: Final[Dict[str, Callable]] = {
+    "crc32": Crc32,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "md5": hashlib.md5,
+}
+
+
+def new_hasher(algorithm: str):
+    """
+    Return a fresh hasher for the given S3 checksum algorithm.
+
+    :param algorithm: Name of the algorithm, e. g. `crc32` or `sha256`.
+
+    Raises
+    ------
+        ValueError: If the algorithm is not supported by the proxy.
+
+    """
+    try:
+        return ALGORITHMS[algorithm.lower()]()
+    except KeyError as e:
+        msg = f"Unsupported checksum algorithm {algorithm}"
+        raise ValueError(msg) from e
+
+
+def b64digest(hasher) -> str:
+    return base64.b64encode(hasher.digest()).decode()
+
+
+def algorithm_from_header(header: str) -> Optional[str]:
+    """Return the algorithm of a `x-amz-checksum-*` header or None."""
+    header = header.lower()
+    if not header.startswith(CHECKSUM_HEADER_PREFIX):
+        return None
+    return header[len(CHECKSUM_HEADER_PREFIX) :]
+
+
+class Checksums(NamedTuple):
+    """Base64 digests by algorithm of the plaintext and the ciphertext of an upload."""
+
+    plaintext: Dict[str, str]
+    ciphertext: Dict[str, str]
+
+
+def requested_algorithms(headers: Mapping[str, str]) -> List[str]:
+    """
+    Return the checksum algorithms a client sent (or announced) checksums for.
+
+    This includes algorithms the proxy doesn't support, see `unsupported`.
+    """
+    requested = []
+    if "Content-MD5" in headers:
+        requested.append("md5")
+    sdk_algorithm = headers.get("X-Amz-Sdk-Checksum-Algorithm")
+    trailers = headers.get("X-Amz-Trailer", "").split(",")
+    for algorithm in [
+        *(algorithm_from_header(header) for header in headers),
+        *(algorithm_from_header(trailer.strip()) for trailer in trailers),
+        sdk_algorithm.lower() if sdk_algorithm else None,
+    ]:
+        if (
+            algorithm
+            and algorithm not in CHECKSUM_PARAMETERS
+            and algorithm not in requested
+        ):
+            requested.append(algorithm)
+    return requested
+
+
+def unsupported(algorithms: List[str]) -> List[str]:
+    return [algorithm for algorithm in algorithms if algorithm not in ALGORITHMS]
+
+
+def payload_sha256(headers: Mapping[str, str]) -> Optional[str]:
+    """Return the payload hash the client signed, unless it's a placeholder."""
+    value = headers.get("X-Amz-Content-Sha256", "")
+    return value.lower() if _sha256_hex_re.match(value) else None
+
+
+def stored_algorithm(requested: List[str]) -> str:
+    """Return the algorithm of the plaintext checksum stored with an object."""
+    return requested[0] if requested else settings.PLAINTEXT_CHECKSUM_ALGORITHM
+
+
+def verify_checksums(
+    headers: Mapping[str, str],
+    plaintext: Dict[str, str],
+) -> Optional[str]:
+    """Compare the checksums sent by the client to those of the plaintext."""
+    expected = {f"{CHECKSUM_HEADER_PREFIX}{a}": d for a, d in plaintext.items()}
+    expected["content-md5"] = plaintext.get("md5")
+    for header, value in headers.items():
+        if header.lower() in expected and value != expected[header.lower()]:
+            return f"{header} does not match the uploaded data"
+    sha256 = payload_sha256(headers)
+    if sha256 and base64.b64decode(plaintext["sha256"]).hex() != sha256:
+        return "X-Amz-Content-Sha256 does not match the uploaded data"
+    return None
+
+
+def is_checksum_header(name: str) -> bool:
+    """Return whether the header `name` carries or announces a checksum."""
+    return name.lower() in {
+        "content-md5",
+        "x-amz-sdk-checksum-algorithm",
+        "x-amz-trailer",
+    } or bool(algorithm_from_header(name))
+
+
+def replace_checksum_headers(
+    headers: CIMultiDict,
+    ciphertext: Dict[str, str],
+) -> None:
+    """
+    Replace all checksums of the client in `headers` with those of the ciphertext.
+
+    Checksums announced for a trailer or by the SDK are dropped as well, upstream
+    would expect them to match the ciphertext.
+    """
+    for header in {h for h in headers if is_checksum_header(h)}:
+        headers.popall(header, None)
+    for algorithm, digest in ciphertext.items():
+        if algorithm == "md5":
+            headers["Content-MD5"] = digest
+        else:
+            headers[f"{CHECKSUM_HEADER_PREFIX}{algorithm}"] = digest
+
+
+def format_checksum(algorithm: str, digest: str) -> str:
+    return f"{algorithm}:{digest}"
+
+
+def parse_checksum(value: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Parse the stored plaintext checksum, i. e. `<algorithm>:<base64 digest>`."""
+    algorithm, _, digest = (value or "").partition(":")
+    if algorithm not in ALGORITHMS or not digest:
+        return None
+    return algorithm, digest
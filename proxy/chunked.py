@@ -0,0 +1,351 @@
+"""
+Incremental decoding of `aws-chunked` request bodies.
+
+AWS SDKs upload large objects with `Content-Encoding: aws-chunked`. The body is
+then framed into chunks, each of them prefixed with its size and (for signed
+payloads) a signature chained to the seed signature of the `Authorization` header:
+
+    <hex-size>;chunk-signature=<signature> CRLF <data> CRLF
+
+The final chunk has size 0 and may be followed by trailing headers carrying a
+checksum over the payload (`x-amz-checksum-*`) and the trailer signature.
+
+See https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-streaming.html
+"""
+import hashlib
+import logging
+from typing import AsyncIterator, Dict, Final, List, Optional
+
+from aiohttp import web
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from proxy import sigv4
+from proxy.checksums import algorithm_from_header, b64digest, new_hasher
+from proxy.conf import settings
+
+log = logging.getLogger("aiohttp.server")
+
+# x-amz-content-sha256 values that announce an aws-chunked body mapped to whether
+# the chunks are signed and whether the body carries trailing headers.
+STREAMING_PAYLOADS: Final = {
+    "STREAMING-AWS4-HMAC-SHA256-PAYLOAD": (True, False),
+    "STREAMING-AWS4-HMAC-SHA256-PAYLOAD-TRAILER": (True, True),
+    "STREAMING-UNSIGNED-PAYLOAD-TRAILER": (False, True),
+}
+
+# headers describing the chunk framing that must not be forwarded upstream once
+# the body has been decoded. The trailing checksum has been verified by the proxy
+# and isn't forwarded either.
+FRAMING_HEADERS: Final = (
+    "X-Amz-Decoded-Content-Length",
+    "X-Amz-Trailer",
+    "X-Amz-Sdk-Checksum-Algorithm",
+)
+
+MAX_LINE_LENGTH: Final = 4096
+
+_HEADER, _DATA, _DATA_CRLF, _TRAILER, _FINAL_CRLF, _DONE = range(6)
+
+
+class AwsChunkedError(ValueError):
+    """Raised if an aws-chunked body is malformed or fails verification."""
+
+
+def is_aws_chunked(request: web.Request) -> bool:
+    if request.headers.get("X-Amz-Content-Sha256") in STREAMING_PAYLOADS:
+        return True
+    encodings = request.headers.get("Content-Encoding", "").lower().split(",")
+    return "aws-chunked" in [e.strip() for e in encodings]
+
+
+def strip_aws_chunked_headers(headers: CIMultiDictProxy) -> CIMultiDict:
+    """
+    Return a copy of `headers` describing the decoded instead of the framed body.
+
+    The client's signature doesn't cover the result, it has to be signed again.
+    """
+    headers = CIMultiDict(headers)
+    encodings = [
+        e.strip()
+        for e in headers.pop("Content-Encoding", "").split(",")
+        if e.strip() and e.strip().lower() != "aws-chunked"
+    ]
+    if encodings:
+        headers["Content-Encoding"] = ", ".join(encodings)
+    for header in FRAMING_HEADERS:
+        headers.popall(header, None)
+    headers["X-Amz-Content-Sha256"] = "UNSIGNED-PAYLOAD"
+    return headers
+
+
+class AwsChunkedDecoder:
+    """
+    Push-style decoder for aws-chunked bodies.
+
+    Feed the raw body as it arrives with `feed`, which returns the payload bytes
+    that could be decoded so far. Call `close` once the body is exhausted to
+    verify it was complete and that trailing checksums match.
+
+    Chunk signatures are only verified cryptographically if `signing_key` is
+    given. Without it the framing is still validated.
+    """
+
+    def __init__(
+        self,
+        *,
+        signed: bool = False,
+        trailer: bool = False,
+        signing_key: Optional[bytes] = None,
+        seed_signature: Optional[str] = None,
+        timestamp: Optional[str] = None,
+        scope: Optional[str] = None,
+        trailer_checksum: Optional[str] = None,
+        decoded_length: Optional[int] = None,
+    ) -> None:
+        self.signed = signed
+        self.trailer = trailer
+        self.signing_key = signing_key
+        self.timestamp = timestamp
+        self.scope = scope
+        self.decoded_length = decoded_length
+        self.trailers: Dict[str, str] = {}
+
+        self._previous_signature = seed_signature
+        self._state = _HEADER
+        self._buf = bytearray()
+        self._remaining = 0
+        self._chunk_signature: Optional[str] = None
+        self._chunk_hash = hashlib.sha256()
+        self._decoded = 0
+
+        self._checksum_algorithm = None
+        self._checksum = None
+        if trailer_checksum:
+            self._checksum_algorithm = algorithm_from_header(trailer_checksum)
+            try:
+                self._checksum = new_hasher(self._checksum_algorithm or "")
+            except ValueError:
+                log.warning(
+                    "Can't verify trailing checksum {checksum} of aws-chunked body.",
+                    extra={"checksum": trailer_checksum},
+                )
+
+    @classmethod
+    def from_request(cls, request: web.Request) -> "AwsChunkedDecoder":
+        signed, trailer = STREAMING_PAYLOADS.get(
+            request.headers.get("X-Amz-Content-Sha256"),
+            (False, False),
+        )
+        credential = sigv4.parse_authorization(request.headers.get("Authorization"))
+        signing_key = None
+        secret = credential and settings.CLIENT_CREDENTIALS.get(credential.access_key)
+        if signed and secret:
+            signing_key = sigv4.derive_signing_key(
+                secret,
+                credential.date,
+                credential.region,
+                credential.service,
+            )
+        elif signed:
+            log.debug(
+                "No secret known for {credential}, skipping chunk signature check.",
+                extra={"credential": credential},
+            )
+
+        decoded_length = request.headers.get("X-Amz-Decoded-Content-Length")
+        try:
+            decoded_length = int(decoded_length) if decoded_length else None
+        except ValueError as e:
+            msg = "Invalid x-amz-decoded-content-length"
+            raise AwsChunkedError(msg) from e
+
+        return cls(
+            signed=signed,
+            trailer=trailer,
+            signing_key=signing_key,
+            seed_signature=credential.signature if credential else None,
+            timestamp=request.headers.get("X-Amz-Date"),
+            scope=credential.scope if credential else None,
+            trailer_checksum=request.headers.get("X-Amz-Trailer"),
+            decoded_length=decoded_length,
+        )
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Feed raw body bytes and return the decoded payload pieces."""
+        self._buf += data
+        out = []
+        while self._buf and self._state != _DONE:
+            if self._state == _DATA:
+                out.append(self._read_data())
+            elif self._state == _DATA_CRLF:
+                if len(self._buf) < 2:
+                    break
+                self._read_data_crlf()
+            else:
+                line = self._readline()
+                if line is None:
+                    break
+                self._parse_line(line)
+
+        if self._state == _DONE and self._buf.strip():
+            msg = "Unexpected data after final chunk"
+            raise AwsChunkedError(msg)
+        return out
+
+    def close(self) -> None:
+        """Verify that the body was complete."""
+        if self._state != _DONE:
+            msg = "Incomplete aws-chunked body"
+            raise AwsChunkedError(msg)
+        if self.decoded_length is not None and self._decoded != self.decoded_length:
+            msg = (
+                f"Decoded {self._decoded} bytes but x-amz-decoded-content-length "
+                f"announced {self.decoded_length}"
+            )
+            raise AwsChunkedError(msg)
+        if self._checksum is not None:
+            expected = self.trailers.get(f"x-amz-checksum-{self._checksum_algorithm}")
+            if expected is None:
+                msg = f"Missing trailing checksum {self._checksum_algorithm}"
+                raise AwsChunkedError(msg)
+            if b64digest(self._checksum) != expected:
+                msg = f"Trailing checksum {self._checksum_algorithm} does not match"
+                raise AwsChunkedError(msg)
+
+    def _readline(self) -> Optional[str]:
+        end = self._buf.find(b"\r\n")
+        if end < 0:
+            if len(self._buf) > MAX_LINE_LENGTH:
+                msg = "Chunk header exceeds maximum length"
+                raise AwsChunkedError(msg)
+            return None
+        line = self._buf[:end].decode("ascii", errors="replace")
+        del self._buf[: end + 2]
+        return line
+
+    def _read_data(self) -> bytes:
+        piece = bytes(self._buf[: self._remaining])
+        del self._buf[: len(piece)]
+        self._remaining -= len(piece)
+        self._decoded += len(piece)
+        if self.signing_key:
+            self._chunk_hash.update(piece)
+        if self._checksum is not None:
+            self._checksum.update(piece)
+        if not self._remaining:
+            self._state = _DATA_CRLF
+        return piece
+
+    def _read_data_crlf(self) -> None:
+        if self._buf[:2] != b"\r\n":
+            msg = "Chunk data is not terminated by CRLF"
+            raise AwsChunkedError(msg)
+        del self._buf[:2]
+        self._verify_chunk()
+        self._state = _HEADER
+
+    def _parse_line(self, line: str) -> None:
+        if self._state == _HEADER:
+            self._parse_chunk_header(line)
+        elif self._state == _TRAILER:
+            self._parse_trailer(line)
+        elif line:
+            msg = "Unexpected data after final chunk"
+            raise AwsChunkedError(msg)
+        else:
+            self._state = _DONE
+
+    def _parse_chunk_header(self, line: str) -> None:
+        size, _, extension = line.partition(";")
+        try:
+            self._remaining = int(size, 16)
+        except ValueError as e:
+            msg = f"Invalid chunk size {size!r}"
+            raise AwsChunkedError(msg) from e
+
+        name, _, signature = extension.partition("=")
+        self._chunk_signature = signature.strip() if extension else None
+        if self.signed and (
+            name.strip() != "chunk-signature" or not self._chunk_signature
+        ):
+            msg = "Missing chunk signature"
+            raise AwsChunkedError(msg)
+
+        if self._remaining:
+            self._state = _DATA
+            return
+
+        # the final, empty chunk is signed like any other chunk
+        self._verify_chunk()
+        self._state = _TRAILER if self.trailer else _FINAL_CRLF
+
+    def _parse_trailer(self, line: str) -> None:
+        if not line:
+            self._state = _DONE
+            return
+        name, sep, value = line.partition(":")
+        if not sep:
+            msg = f"Invalid trailing header {line!r}"
+            raise AwsChunkedError(msg)
+        name = name.strip().lower()
+        if name == "x-amz-trailer-signature":
+            self._verify_trailer(value.strip())
+            return
+        self.trailers[name] = value.strip()
+
+    def _verify_chunk(self) -> None:
+        if not self.signing_key:
+            return
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256-PAYLOAD",
+                self.timestamp or "",
+                self.scope or "",
+                self._previous_signature or "",
+                sigv4.EMPTY_SHA256,
+                self._chunk_hash.hexdigest(),
+            ],
+        )
+        expected = sigv4.sign(self.signing_key, string_to_sign)
+        if not sigv4.signatures_match(expected, self._chunk_signature or ""):
+            msg = "Chunk signature does not match"
+            raise AwsChunkedError(msg)
+        self._previous_signature = expected
+        self._chunk_hash = hashlib.sha256()
+
+    def _verify_trailer(self, signature: str) -> None:
+        if not self.signing_key:
+            return
+        canonical = "".join(f"{k}:{v}\n" for k, v in self.trailers.items())
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256-TRAILER",
+                self.timestamp or "",
+                self.scope or "",
+                self._previous_signature or "",
+                hashlib.sha256(canonical.encode()).hexdigest(),
+            ],
+        )
+        expected = sigv4.sign(self.signing_key, string_to_sign)
+        if not sigv4.signatures_match(expected, signature):
+            msg = "Trailer signature does not match"
+            raise AwsChunkedError(msg)
+
+
+async def iter_aws_chunked(request: web.Request) -> AsyncIterator[bytes]:
+    """Yield the decoded payload of an aws-chunked request as it arrives."""
+    decoder = AwsChunkedDecoder.from_request(request)
+    async for data in request.content.iter_any():
+        for piece in decoder.feed(data):
+            yield piece
+    decoder.close()
+
+
+async def iter_payload(request: web.Request) -> AsyncIterator[bytes]:
+    """Yield the payload of an upload request, decoding aws-chunked framing."""
+    if is_aws_chunked(request):
+        async for piece in iter_aws_chunked(request):
+            yield piece
+        return
+    async for data in request.content.iter_any():
+        yield data
@@ -1,11 +1,28 @@
 import base64
+import os
+import time
+from typing import Final, Iterable, Optional, Tuple
 
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidSignature
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from proxy.checksums import Checksums, b64digest, new_hasher
 from proxy.conf import settings
 
+# A Fernet token is the urlsafe base64 encoding of
+# version (1) | timestamp (8) | IV (16) | AES-CBC ciphertext | HMAC (32)
+# where the ciphertext is the PKCS7 padded plaintext.
+FERNET_OVERHEAD: Final = 1 + 8 + 16 + 32
+FERNET_HEADER_SIZE: Final = 1 + 8 + 16
+FERNET_VERSION: Final = 0x80
+HMAC_SIZE: Final = 32
+BLOCK_SIZE: Final = 16
+
+CHECKSUM_CHUNK_SIZE: Final = 1024 * 1024
+
 
 def generate_key(object_id: str) -> str:
     kdf = PBKDF2HMAC(
@@ -27,3 +44,233 @@ def decrypt(object_id: str, encrypted: bytes) -> bytes:
     key = generate_key(object_id)
     f = Fernet(key)
     return f.decrypt(encrypted)
+
+
+def plaintext_size(token_size: int) -> int:
+    """
+    Return the plaintext size of a Fernet token of `token_size` bytes.
+
+    The padding hides the exact size, the result is the largest plaintext that
+    encrypts to a token of that size. It is never more than 15 bytes off.
+    """
+    raw_size = token_size // 4 * 3
+    # base64 padding accounts for up to two bytes
+    for size in range(raw_size, raw_size - 3, -1):
+        ciphertext_size = size - FERNET_OVERHEAD
+        if ciphertext_size >= BLOCK_SIZE and ciphertext_size % BLOCK_SIZE == 0:
+            return ciphertext_size - 1
+    msg = f"{token_size} is not the size of a Fernet token"
+    raise ValueError(msg)
+
+
+def _fernet_keys(object_id: str) -> Tuple[bytes, bytes]:
+    """Return the signing and the encryption key of the Fernet key."""
+    key = base64.urlsafe_b64decode(generate_key(object_id))
+    return key[:16], key[16:]
+
+
+class _Base64Decoder:
+    def __init__(self) -> None:
+        self._buf = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._buf + data
+        end = len(data) - len(data) % 4
+        self._buf = data[end:]
+        return base64.urlsafe_b64decode(data[:end])
+
+    def close(self) -> bytes:
+        if self._buf:
+            msg = "Truncated base64 data"
+            raise InvalidToken(msg)
+        return b""
+
+
+class _Base64Encoder:
+    def __init__(self) -> None:
+        self._buf = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._buf + data
+        end = len(data) - len(data) % 3
+        self._buf = data[end:]
+        return base64.urlsafe_b64encode(data[:end])
+
+    def close(self) -> bytes:
+        return base64.urlsafe_b64encode(self._buf)
+
+
+class StreamDecryptor:
+    """
+    Incremental decryption of a Fernet token.
+
+    The HMAC of the token is only verified by `close`, plaintext returned by `feed`
+    must not be trusted (or published) before it succeeded.
+    """
+
+    def __init__(self, object_id: str) -> None:
+        self._signing_key, self._encryption_key = _fernet_keys(object_id)
+        self._base64 = _Base64Decoder()
+        self._hmac = hmac.HMAC(self._signing_key, hashes.SHA256())
+        self._decryptor = None
+        self._unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        self._buf = b""
+
+    def feed(self, data: bytes) -> bytes:
+        self._buf += self._base64.feed(data)
+        if self._decryptor is None:
+            if len(self._buf) < FERNET_HEADER_SIZE:
+                return b""
+            header = self._buf[:FERNET_HEADER_SIZE]
+            if header[0] != FERNET_VERSION:
+                raise InvalidToken
+            self._hmac.update(header)
+            iv = header[9:FERNET_HEADER_SIZE]
+            self._decryptor = Cipher(
+                algorithms.AES(self._encryption_key),
+                modes.CBC(iv),
+            ).decryptor()
+            self._buf = self._buf[FERNET_HEADER_SIZE:]
+
+        # hold back the HMAC and the last block which carries the padding
+        size = len(self._buf) - HMAC_SIZE - BLOCK_SIZE
+        if size < BLOCK_SIZE:
+            return b""
+        size -= size % BLOCK_SIZE
+        ciphertext, self._buf = self._buf[:size], self._buf[size:]
+        self._hmac.update(ciphertext)
+        return self._unpadder.update(self._decryptor.update(ciphertext))
+
+    def close(self) -> bytes:
+        """Verify the token and return the rest of the plaintext."""
+        self._buf += self._base64.close()
+        ciphertext, signature = self._buf[:-HMAC_SIZE], self._buf[-HMAC_SIZE:]
+        if (
+            self._decryptor is None
+            or len(signature) < HMAC_SIZE
+            or len(ciphertext) % BLOCK_SIZE
+        ):
+            raise InvalidToken
+        self._hmac.update(ciphertext)
+        try:
+            self._hmac.verify(signature)
+        except InvalidSignature as e:
+            raise InvalidToken from e
+        plain = self._decryptor.update(ciphertext) + self._decryptor.finalize()
+        try:
+            return self._unpadder.update(plain) + self._unpadder.finalize()
+        except ValueError as e:
+            raise InvalidToken from e
+
+
+class VerifyingDecryptor(StreamDecryptor):
+    """`StreamDecryptor` that verifies the `(algorithm, digest)` of the plaintext, too."""
+
+    def __init__(self, object_id: str, expected: Optional[Tuple[str, str]]) -> None:
+        super().__init__(object_id)
+        self._expected = expected
+        self._hasher = new_hasher(expected[0]) if expected else None
+
+    def feed(self, data: bytes) -> bytes:
+        plain = super().feed(data)
+        if self._hasher is not None:
+            self._hasher.update(plain)
+        return plain
+
+    def close(self) -> bytes:
+        """Verify the token and the checksum and return the rest of the plaintext."""
+        plain = super().close()
+        if self._hasher is not None:
+            self._hasher.update(plain)
+            if b64digest(self._hasher) != self._expected[1]:
+                msg = "Checksum of the plaintext does not match"
+                raise InvalidToken(msg)
+        return plain
+
+
+class StreamEncryptor:
+    """Incremental encryption into a Fernet token, the same `encrypt` creates."""
+
+    def __init__(self, object_id: str) -> None:
+        signing_key, encryption_key = _fernet_keys(object_id)
+        iv = os.urandom(16)
+        header = bytes([FERNET_VERSION]) + int(time.time()).to_bytes(8, "big") + iv
+        self._base64 = _Base64Encoder()
+        self._hmac = hmac.HMAC(signing_key, hashes.SHA256())
+        self._hmac.update(header)
+        self._encryptor = Cipher(
+            algorithms.AES(encryption_key),
+            modes.CBC(iv),
+        ).encryptor()
+        self._padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        self._header = header
+
+    def _encrypt(self, padded: bytes) -> bytes:
+        ciphertext = self._encryptor.update(padded)
+        self._hmac.update(ciphertext)
+        header, self._header = self._header, b""
+        return self._base64.feed(header + ciphertext)
+
+    def feed(self, data: bytes) -> bytes:
+        return self._encrypt(self._padder.update(data))
+
+    def close(self) -> bytes:
+        out = self._encrypt(self._padder.finalize())
+        ciphertext = self._encryptor.finalize()
+        self._hmac.update(ciphertext)
+        return (
+            out
+            + self._base64.feed(ciphertext + self._hmac.finalize())
+            + self._base64.close()
+        )
+
+
+def encrypt_with_checksums(
+    object_id: str,
+    plain: bytes,
+    plaintext_algorithms: Iterable[str],
+    ciphertext_algorithms: Iterable[str],
+) -> Tuple[bytes, Checksums]:
+    """
+    Encrypt `plain` like `encrypt` and checksum plaintext and token on the way.
+
+    Both are hashed chunk by chunk in the same pass that encrypts them, while each
+    chunk is still in the cache.
+    """
+    plain_hashers = {a: new_hasher(a) for a in plaintext_algorithms}
+    token_hashers = {a: new_hasher(a) for a in ciphertext_algorithms}
+    encryptor = StreamEncryptor(object_id)
+    view = memoryview(plain)
+    pieces = []
+    for offset in range(0, len(plain), CHECKSUM_CHUNK_SIZE):
+        chunk = view[offset : offset + CHECKSUM_CHUNK_SIZE]
+        for hasher in plain_hashers.values():
+            hasher.update(chunk)
+        pieces.append(encryptor.feed(chunk))
+        for hasher in token_hashers.values():
+            hasher.update(pieces[-1])
+    pieces.append(encryptor.close())
+    for hasher in token_hashers.values():
+        hasher.update(pieces[-1])
+    return b"".join(pieces), Checksums(
+        plaintext={a: b64digest(h) for a, h in plain_hashers.items()},
+        ciphertext={a: b64digest(h) for a, h in token_hashers.items()},
+    )
+
+
+def decrypt_with_checksum(
+    object_id: str,
+    token: bytes,
+    algorithm: str,
+) -> Tuple[bytes, str]:
+    """Decrypt `token` like `decrypt` and return the checksum of the plaintext."""
+    hasher = new_hasher(algorithm)
+    decryptor = StreamDecryptor(object_id)
+    view = memoryview(token)
+    pieces = []
+    for offset in range(0, len(token), CHECKSUM_CHUNK_SIZE):
+        pieces.append(decryptor.feed(view[offset : offset + CHECKSUM_CHUNK_SIZE]))
+        hasher.update(pieces[-1])
+    pieces.append(decryptor.close())
+    hasher.update(pieces[-1])
+    return b"".join(pieces), b64digest(hasher)
@@ -1,5 +1,6 @@
-from typing import List, NamedTuple
+from typing import Dict, List, NamedTuple, Optional
 
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -8,10 +9,69 @@ class Settings(BaseSettings):
     OBJECT_STORE_HOST: str = "minio"
     OBJECT_STORE_PORT: int = 9000
     OBJECT_STORE_SSL_ENABLED: bool = True
+    # several object store nodes, e. g. ["http://minio1:9000", "http://minio2:9000"].
+    # Requests are balanced over them instead of going to OBJECT_STORE_HOST.
+    OBJECT_STORE_ENDPOINTS: List[str] = []
+    # "least_outstanding" or "latency"
+    UPSTREAM_BALANCING: str = "least_outstanding"
+    # endpoints failing this many times in a row are ejected for a while
+    UPSTREAM_MAX_FAILURES: int = 3
+    UPSTREAM_EJECTION_TIME: float = 30
+    # connections per endpoint
+    UPSTREAM_POOL_SIZE: int = 100
+    # retries of idempotent upstream requests and hedging of GET/HEAD requests
+    # that haven't responded after the given percentile of recent latencies
+    # (e. g. 95, hedging is off by default).
+    UPSTREAM_RETRIES: int = 2
+    UPSTREAM_RETRY_BACKOFF: float = 0.05
+    UPSTREAM_CONNECT_TIMEOUT: Optional[float] = 5
+    UPSTREAM_READ_TIMEOUT: Optional[float] = 60
+    UPSTREAM_HEDGE_PERCENTILE: Optional[float] = None
+    UPSTREAM_HEDGE_MIN_DELAY: float = 0.05
     SECRET: str
     LOG_LEVEL: str = "info"
     ENVIRONMENT: str = "development"
     DEBUG_SESSION: bool = False
+    # access key id -> secret key of clients the proxy verifies signatures of and
+    # signs changed requests for (aws-chunked uploads, copies of encrypted objects)
+    CLIENT_CREDENTIALS: Dict[str, str] = {}
+    # threads for non-blocking hooks consuming uploads as a stream (`data="stream"`).
+    # Further streaming hooks wait for a free thread.
+    HOOK_STREAM_WORKERS: int = 16
+    # verdicts of hooks registered with `cache=True`
+    VERDICT_CACHE_SIZE: int = 10000
+    VERDICT_CACHE_TTL: int = 24 * 60 * 60
+    # report the plaintext size derived from the ciphertext size in listings that
+    # don't include the stored plaintext size. It may be up to 15 bytes too large.
+    LISTING_SIZE_ESTIMATE_ENABLED: bool = False
+    # share one upstream fetch between concurrent GETs of the same object
+    GET_COALESCING_ENABLED: bool = True
+    # fetch objects larger than the threshold as parallel ranges
+    RANGED_FETCH_ENABLED: bool = False
+    RANGED_FETCH_THRESHOLD: int = 32 * 1024 * 1024
+    RANGED_FETCH_PART_SIZE: int = 8 * 1024 * 1024
+    RANGED_FETCH_CONCURRENCY: int = 4
+    # CopyObject of encrypted objects is streamed through the proxy and uploaded
+    # in parts of this size if it doesn't fit into one part. S3 rejects parts
+    # smaller than 5 MiB (except for the last one).
+    COPY_PART_SIZE: int = Field(16 * 1024 * 1024, ge=5 * 1024 * 1024)
+    # checksum of the plaintext stored with encrypted objects and verified when
+    # they're decrypted, if the client didn't upload a checksum of its own.
+    PLAINTEXT_CHECKSUM_ALGORITHM: str = "crc32"
+    # deliver post_upload hooks from a queue persisted in sqlite instead of
+    # awaiting them before responding to the upload.
+    POST_UPLOAD_QUEUE_ENABLED: bool = False
+    POST_UPLOAD_QUEUE_PATH: str = "post_upload_queue.sqlite3"
+    POST_UPLOAD_QUEUE_MAXSIZE: int = 10000
+    POST_UPLOAD_QUEUE_WORKERS: int = 4
+    # events a worker claims at once, their hooks are called one event after another
+    POST_UPLOAD_QUEUE_CLAIM_SIZE: int = 16
+    POST_UPLOAD_QUEUE_MAX_ATTEMPTS: int = 8
+    POST_UPLOAD_QUEUE_BACKOFF: float = 1.0
+    # seconds dead letters are kept, at most POST_UPLOAD_QUEUE_MAXSIZE of them
+    POST_UPLOAD_QUEUE_DEAD_RETENTION: int = 7 * 24 * 60 * 60
+    # bearer token required by `GET /_proxy/stats`, it's disabled without one
+    STATS_TOKEN: Optional[str] = None
     ALLOWED_METHODS: List[str] = [
         "GET",
         "PUT",
@@ -46,10 +46,28 @@ def settings(request):
     the settings to override.
     """
 
-    if request.param is not None:
-        for variable, value in request.param.items():
-            setattr(conf_settings, variable, value)
-    return conf_settings
+    overrides = request.param or {}
+    original = {variable: getattr(conf_settings, variable) for variable in overrides}
+    for variable, value in overrides.items():
+        setattr(conf_settings, variable, value)
+    yield conf_settings
+    for variable, value in original.items():
+        setattr(conf_settings, variable, value)
+
+
+class FakeClock:
+    """Monotonic clock for tests, advanced by setting `now`."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
 
 
 @pytest.fixture
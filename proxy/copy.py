@@ -0,0 +1,368 @@
+"""
+CopyObject of encrypted objects.
+
+Objects are encrypted with a key derived from their name, so a copy made by the
+object store can't be decrypted under the destination name. Instead the proxy
+streams the source from upstream, decrypts and re-encrypts it for the destination
+chunk by chunk and uploads the result: with a single PUT if it fits into one part,
+as a multipart upload otherwise. At most about two parts are held in memory.
+
+The proxy has no credentials of its own, the requests are signed on behalf of the
+client (see `proxy.auth`).
+"""
+import asyncio
+import contextlib
+import re
+from datetime import datetime, timezone
+from typing import Final, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+
+import aiohttp
+from aiohttp import web
+from cryptography.fernet import InvalidToken
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from proxy import sigv4
+from proxy.auth import AuthError, Credentials, client_credentials
+from proxy.checksums import PLAINTEXT_CHECKSUM_HEADER
+from proxy.ciphers import StreamDecryptor, StreamEncryptor
+from proxy.conf import settings
+from proxy.events import pre_copy
+from proxy.listing import PLAINTEXT_SIZE_HEADER
+from proxy.utils import S3Object, extract_object_props
+
+COPY_SOURCE_HEADER: Final = "X-Amz-Copy-Source"
+
+READ_CHUNK_SIZE: Final = 256 * 1024
+
+# headers describing the object, copied from the source unless the request asks
+# to replace them with its own (`x-amz-metadata-directive: REPLACE`)
+OBJECT_HEADERS: Final = frozenset(
+    [
+        "cache-control",
+        "content-disposition",
+        "content-encoding",
+        "content-language",
+        "content-type",
+        "expires",
+    ],
+)
+
+# headers of the copy request that apply to the destination object
+DESTINATION_HEADERS: Final = (
+    "X-Amz-Acl",
+    "X-Amz-Expected-Bucket-Owner",
+    "X-Amz-Object-Lock-Legal-Hold",
+    "X-Amz-Object-Lock-Mode",
+    "X-Amz-Object-Lock-Retain-Until-Date",
+    "X-Amz-Server-Side-Encryption",
+    "X-Amz-Storage-Class",
+    "X-Amz-Website-Redirect-Location",
+)
+
+# conditions on the copy source mapped to the conditions of the source GET
+SOURCE_CONDITIONS: Final = {
+    "X-Amz-Copy-Source-If-Match": "If-Match",
+    "X-Amz-Copy-Source-If-None-Match": "If-None-Match",
+    "X-Amz-Copy-Source-If-Modified-Since": "If-Modified-Since",
+    "X-Amz-Copy-Source-If-Unmodified-Since": "If-Unmodified-Since",
+}
+
+_upload_id_re: Final = re.compile(rb"<UploadId>([^<]+)</UploadId>")
+_etag_re: Final = re.compile(rb"<ETag>([^<]+)</ETag>")
+
+
+class CopyError(Exception):
+    def __init__(self, status: int, reason: str) -> None:
+        super().__init__(reason)
+        self.status = status
+
+
+class CopyRejectedError(Exception):
+    """A `pre_copy` hook rejected the copy."""
+
+    def __init__(self, results: list) -> None:
+        super().__init__("Copy rejected by pre_copy hooks.")
+        self.results = results
+
+
+class CopySource(NamedTuple):
+    bucket: str
+    name: str
+    version_id: Optional[str] = None
+
+    @property
+    def path(self) -> str:
+        return f"/{self.bucket}/{self.name}"
+
+
+def is_copy_request(request: web.Request) -> bool:
+    return request.method == "PUT" and COPY_SOURCE_HEADER in request.headers
+
+
+def parse_copy_source(value: str) -> Optional[CopySource]:
+    """Parse `x-amz-copy-source`, i. e. `[/]bucket/key[?versionId=...]`."""
+    path, _, query = value.partition("?")
+    parts = unquote(path).lstrip("/").split("/")
+    if len(parts) != 2 or not all(parts):
+        return None
+    version_id = URL.build(query_string=query).query.get("versionId")
+    return CopySource(bucket=parts[0], name=parts[1], version_id=version_id)
+
+
+def copy_result(etag: str) -> bytes:
+    """Return the CopyObjectResult document of a successful copy."""
+    last_modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<CopyObjectResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        f"<LastModified>{last_modified}</LastModified>"
+        f"<ETag>{escape(etag)}</ETag>"
+        "</CopyObjectResult>"
+    ).encode()
+
+
+class ObjectCopy:
+    """
+    Copy an encrypted object, re-encrypting it for the destination.
+
+    :param host: URL of the object store.
+    :param part_size: Size of the parts of the multipart upload. Objects that fit
+                      into a single part are uploaded with a single PUT.
+    """
+
+    def __init__(
+        self,
+        request: web.Request,
+        source: CopySource,
+        destination: S3Object,
+        host: URL,
+        credentials: Credentials,
+        part_size: int,
+    ) -> None:
+        self.request = request
+        self.source = source
+        self.destination = destination
+        self.host = host
+        self.credentials = credentials
+        self.part_size = part_size
+        self.size = 0
+
+        self._headers = CIMultiDict()
+        self._upload_id: Optional[str] = None
+        self._parts: List[str] = []
+        self._pending: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_request(cls, request: web.Request, host: URL) -> "ObjectCopy":
+        destination = extract_object_props(request)
+        source = parse_copy_source(request.headers[COPY_SOURCE_HEADER])
+        if destination is None or source is None:
+            msg = "Failed to get bucket and object-id of copy source or destination."
+            raise CopyError(web.HTTPBadRequest.status_code, msg)
+        if "uploadId" in request.query:
+            msg = "UploadPartCopy of encrypted objects is not supported."
+            raise CopyError(web.HTTPNotImplemented.status_code, msg)
+        try:
+            credentials = client_credentials(request)
+        except AuthError as e:
+            raise CopyError(e.status, str(e)) from e
+        if credentials is None:
+            msg = "Copying encrypted objects requires the client's credentials."
+            raise CopyError(web.HTTPNotImplemented.status_code, msg)
+        return cls(
+            request,
+            source,
+            destination,
+            host=host,
+            credentials=credentials,
+            part_size=settings.COPY_PART_SIZE,
+        )
+
+    @property
+    def _path(self) -> str:
+        return f"/{self.destination.bucket}/{self.destination.name}"
+
+    async def _send(self, method: str, path: str, consume, **kwargs):
+        params = kwargs.pop("params", {})
+        headers = CIMultiDict(kwargs.pop("headers", {}))
+        url = sigv4.signed_url(self.host.with_path(path).with_query(params))
+        sigv4.sign_request(method, url, headers, *self.credentials)
+        return await self.request.app["upstream"].request(
+            self.request.app["client_session"],
+            method,
+            url,
+            consume,
+            headers=headers,
+            **kwargs,
+        )
+
+    async def _write(self, method: str, **kwargs) -> Tuple[CIMultiDictProxy, bytes]:
+        """Send a request writing the destination, errors don't retry the copy."""
+
+        async def _read(resp: aiohttp.ClientResponse):
+            resp.raise_for_status()
+            body = await resp.read()
+            if b"<Error>" in body:
+                # CompleteMultipartUpload may fail after responding with 200
+                raise aiohttp.ClientResponseError(
+                    resp.request_info,
+                    resp.history,
+                    status=web.HTTPInternalServerError.status_code,
+                    message="Multipart upload failed.",
+                )
+            return resp.headers, body
+
+        try:
+            return await self._send(method, self._path, _read, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = getattr(e, "status", web.HTTPBadGateway.status_code)
+            msg = f"Failed to write copy destination {self._path}. {e}"
+            raise CopyError(status, msg) from e
+
+    def _destination_headers(self, source_headers: CIMultiDictProxy) -> CIMultiDict:
+        request_headers = self.request.headers
+        directive = request_headers.get("X-Amz-Metadata-Directive", "COPY")
+        origin = request_headers if directive.upper() == "REPLACE" else source_headers
+        headers = CIMultiDict(
+            (k, v)
+            for k, v in origin.items()
+            if k.lower() in OBJECT_HEADERS or k.lower().startswith("x-amz-meta-")
+        )
+        for header in DESTINATION_HEADERS:
+            if header in request_headers:
+                headers[header] = request_headers[header]
+        if request_headers.get("X-Amz-Tagging-Directive", "").upper() == "REPLACE":
+            headers["X-Amz-Tagging"] = request_headers.get("X-Amz-Tagging", "")
+        # the plaintext doesn't change, its size and checksum are kept
+        for header in (PLAINTEXT_SIZE_HEADER, PLAINTEXT_CHECKSUM_HEADER):
+            if header in source_headers:
+                headers[header] = source_headers[header]
+            else:
+                headers.popall(header, None)
+        return headers
+
+    async def _check(self, head: bytes) -> None:
+        results = await pre_copy(self.request, head)
+        if not all(res[1] for res in results):
+            raise CopyRejectedError(results)
+
+    async def _upload_part(self, data: bytes) -> None:
+        if self._upload_id is None:
+            _, body = await self._write(
+                "POST",
+                params={"uploads": ""},
+                headers=self._headers,
+            )
+            match = _upload_id_re.search(body)
+            if match is None:
+                msg = "Failed to create multipart upload."
+                raise CopyError(web.HTTPBadGateway.status_code, msg)
+            self._upload_id = match[1].decode()
+
+        number = len(self._parts) + 1
+        self._parts.append("")
+        headers, _ = await self._write(
+            "PUT",
+            params={"partNumber": str(number), "uploadId": self._upload_id},
+            data=data,
+        )
+        self._parts[number - 1] = headers.get("ETag", "")
+
+    async def _flush(self, data: bytes) -> None:
+        """Upload a part, while the next one is encrypted."""
+        if self._pending is not None:
+            await self._pending
+        self._pending = asyncio.create_task(self._upload_part(data))
+
+    async def _complete(self) -> str:
+        await self._pending
+        document = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+            for number, etag in enumerate(self._parts, start=1)
+        )
+        _, body = await self._write(
+            "POST",
+            params={"uploadId": self._upload_id},
+            data=f"<CompleteMultipartUpload>{document}</CompleteMultipartUpload>",
+        )
+        match = _etag_re.search(body)
+        return match[1].decode() if match else ""
+
+    async def _put(self, data: bytes) -> str:
+        headers = self._headers.copy()
+        headers[PLAINTEXT_SIZE_HEADER] = str(self.size)
+        response_headers, _ = await self._write("PUT", headers=headers, data=data)
+        return response_headers.get("ETag", "")
+
+    async def _abort(self) -> None:
+        if self._pending is not None:
+            # let a part upload finish, it might be creating the multipart upload
+            with contextlib.suppress(Exception):
+                await self._pending
+        if self._upload_id is not None:
+            with contextlib.suppress(CopyError):
+                await self._write("DELETE", params={"uploadId": self._upload_id})
+
+    async def _reencrypt(self, resp: aiohttp.ClientResponse) -> str:
+        decryptor = StreamDecryptor(self.source.name)
+        encryptor = StreamEncryptor(self.destination.name)
+        # the hooks get (up to) the first part of the plaintext
+        head = bytearray()
+        part = bytearray()
+        async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+            plain = decryptor.feed(chunk)
+            self.size += len(plain)
+            head += plain[: self.part_size - len(head)]
+            part += encryptor.feed(plain)
+            if len(part) >= self.part_size:
+                await self._flush(bytes(part))
+                part.clear()
+
+        # verifies the source. Only then the hooks see its plaintext, parts
+        # uploaded before are discarded if they reject it.
+        plain = decryptor.close()
+        self.size += len(plain)
+        head += plain[: self.part_size - len(head)]
+        await self._check(bytes(head))
+        part += encryptor.feed(plain) + encryptor.close()
+
+        if self._pending is None:
+            return await self._put(bytes(part))
+        await self._flush(bytes(part))
+        return await self._complete()
+
+    async def _copy(self, resp: aiohttp.ClientResponse) -> str:
+        resp.raise_for_status()
+        # the source GET may have been retried
+        self.size, self._upload_id, self._parts, self._pending = 0, None, [], None
+        self._headers = self._destination_headers(resp.headers)
+        try:
+            return await self._reencrypt(resp)
+        except InvalidToken as e:
+            await self._abort()
+            msg = f"Decryption of copy source {self.source.path} failed."
+            raise CopyError(web.HTTPBadRequest.status_code, msg) from e
+        except BaseException:
+            await self._abort()
+            raise
+
+    async def run(self) -> str:
+        """Copy the object and return the ETag of the destination."""
+        headers = CIMultiDict(
+            (condition, self.request.headers[header])
+            for header, condition in SOURCE_CONDITIONS.items()
+            if header in self.request.headers
+        )
+        params = {}
+        if self.source.version_id:
+            params["versionId"] = self.source.version_id
+        return await self._send(
+            "GET",
+            self.source.path,
+            self._copy,
+            params=params,
+            headers=headers,
+        )
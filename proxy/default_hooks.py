@@ -3,7 +3,16 @@ from typing import Tuple, Union
 from aiohttp import web
 from cryptography.fernet import InvalidToken
 
-from proxy.ciphers import decrypt, encrypt
+from proxy.checksums import (
+    EXPECTED_CHECKSUM_KEY,
+    Checksums,
+    payload_sha256,
+    requested_algorithms,
+    stored_algorithm,
+    unsupported,
+    verify_checksums,
+)
+from proxy.ciphers import decrypt, decrypt_with_checksum, encrypt_with_checksums
 from proxy.events import on, post_retrieve_data, pre_upload_before_check
 from proxy.utils import extract_object_props
 
@@ -14,9 +23,27 @@ __all__ = ["hook_encrypt_data", "hook_decrypt_data"]
 def hook_encrypt_data(
     request: web.Request,
     data: bytes,
-) -> Tuple[bool, bytes]:
+) -> Union[Tuple[bool, bytes, Checksums], Tuple[bool, str]]:
     obj = extract_object_props(request)
-    return True, encrypt(obj.name, data)
+    requested = requested_algorithms(request.headers)
+    if unsupported(requested):
+        return False, "Checksum algorithms {} are not supported.".format(
+            ", ".join(unsupported(requested)),
+        )
+    plaintext_algorithms = {*requested, stored_algorithm(requested)}
+    if payload_sha256(request.headers):
+        plaintext_algorithms.add("sha256")
+    token, checksums = encrypt_with_checksums(
+        obj.name,
+        data,
+        plaintext_algorithms=plaintext_algorithms,
+        ciphertext_algorithms=requested,
+    )
+    error = verify_checksums(request.headers, checksums.plaintext)
+    if error is not None:
+        return False, error
+    # the handler sends the checksums of the token upstream
+    return True, token, checksums
 
 
 @on(post_retrieve_data)
@@ -25,10 +52,14 @@ def hook_decrypt_data(
     data: bytes,
 ) -> Tuple[bool, Union[bytes, str]]:
     obj = extract_object_props(request)
-    success = True
+    expected = request.get(EXPECTED_CHECKSUM_KEY)
     try:
-        result = decrypt(obj.name, data)
+        if expected is None:
+            return True, decrypt(obj.name, data)
+        algorithm, digest = expected
+        result, actual = decrypt_with_checksum(obj.name, data, algorithm)
     except InvalidToken:
-        success = False
-        result = "Decryption of {s3obj} failed."
-    return success, result
+        return False, "Decryption of {s3obj} failed."
+    if actual != digest:
+        return False, "Checksum of decrypted {s3obj} does not match."
+    return True, result
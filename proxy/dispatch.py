@@ -0,0 +1,332 @@
+"""
+Durable, asynchronous dispatch of `post_upload` hooks.
+
+Instead of awaiting the `post_upload` hooks before responding to an upload, the
+upload is recorded in a bounded queue persisted in SQLite. Workers claim several
+events at once and call the hooks for one event after another, retrying failed
+deliveries with exponential backoff. Events that still fail after `max_attempts`
+are kept as dead letters for `dead_retention` seconds, at most `maxsize` of them.
+
+Hooks called from the queue receive a `RequestSnapshot` instead of the original
+`web.Request`, which does not outlive the upload.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import random
+import sqlite3
+import time
+from typing import Dict, Final, List, NamedTuple, Optional, Tuple
+
+from aiohttp import web
+from multidict import CIMultiDict, CIMultiDictProxy, MultiDictProxy
+from yarl import URL
+
+from proxy.conf import settings
+from proxy.events import post_upload
+
+log = logging.getLogger("aiohttp.server")
+
+# seconds between pruning expired dead letters
+PRUNE_INTERVAL: Final = 60.0
+
+# credentials are not persisted to disk.
+SKIPPED_HEADERS: Final = frozenset(
+    ["authorization", "cookie", "x-amz-security-token"],
+)
+
+SCHEMA: Final = """
+CREATE TABLE IF NOT EXISTS post_upload (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request TEXT NOT NULL,
+    created REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+)
+"""
+
+
+class RequestSnapshot(NamedTuple):
+    """The parts of an upload request that are passed on to queued hooks."""
+
+    method: str
+    path: str
+    query_string: str
+    headers: CIMultiDictProxy
+
+    @property
+    def url(self) -> URL:
+        return URL.build(path=self.path, query_string=self.query_string)
+
+    @property
+    def query(self) -> MultiDictProxy:
+        return self.url.query
+
+    @classmethod
+    def from_request(cls, request: web.Request) -> "RequestSnapshot":
+        headers = CIMultiDict(
+            (k, v)
+            for k, v in request.headers.items()
+            if k.lower() not in SKIPPED_HEADERS
+        )
+        return cls(
+            method=request.method,
+            path=request.path,
+            query_string=request.query_string,
+            headers=CIMultiDictProxy(headers),
+        )
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "method": self.method,
+                "path": self.path,
+                "query_string": self.query_string,
+                "headers": list(self.headers.items()),
+            },
+        )
+
+    @classmethod
+    def loads(cls, value: str) -> "RequestSnapshot":
+        data = json.loads(value)
+        data["headers"] = CIMultiDictProxy(CIMultiDict(data["headers"]))
+        return cls(**data)
+
+
+class PostUploadQueue:
+    def __init__(
+        self,
+        path: str,
+        maxsize: int = 10000,
+        workers: int = 4,
+        claim_size: int = 16,
+        max_attempts: int = 8,
+        dead_retention: float = 7 * 24 * 60 * 60,
+        backoff: float = 1.0,
+        max_backoff: float = 300.0,
+        poll_interval: float = 1.0,
+    ) -> None:
+        self.path = path
+        self.maxsize = maxsize
+        self.workers = workers
+        self.claim_size = claim_size
+        self.max_attempts = max_attempts
+        self.dead_retention = dead_retention
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.delivered = 0
+        self.failed = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._pruned = 0.0
+
+    async def _execute(self, func, *args):
+        """Run `func(db, *args)` in a thread, one statement batch at a time."""
+        async with self._lock:
+            return await asyncio.to_thread(func, self._db, *args)
+
+    async def open(self) -> None:
+        def _open(_db):
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(SCHEMA)
+            # events claimed by a previous process have not been delivered
+            db.execute("UPDATE post_upload SET claimed = 0 WHERE claimed = 1")
+            db.commit()
+            return db
+
+        self._db = await self._execute(_open)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            await self._execute(lambda db: db.close())
+            self._db = None
+
+    async def put(self, request: web.Request) -> bool:
+        """
+        Enqueue the post_upload hooks for `request`.
+
+        Returns False if the queue is full, the caller should then call the hooks
+        itself.
+        """
+        snapshot = RequestSnapshot.from_request(request)
+
+        def _put(db):
+            (depth,) = db.execute(
+                "SELECT COUNT(*) FROM post_upload WHERE dead = 0",
+            ).fetchone()
+            if depth >= self.maxsize:
+                return False
+            now = time.time()
+            db.execute(
+                "INSERT INTO post_upload (request, created, next_attempt) "
+                "VALUES (?, ?, ?)",
+                (snapshot.dumps(), now, now),
+            )
+            db.commit()
+            return True
+
+        queued = await self._execute(_put)
+        if queued:
+            self._wakeup.set()
+        else:
+            log.warning("post_upload queue is full, calling hooks inline.")
+        return queued
+
+    async def _claim(self) -> List[Tuple[int, str, int]]:
+        def _claim(db):
+            rows = db.execute(
+                "SELECT id, request, attempts FROM post_upload "
+                "WHERE dead = 0 AND claimed = 0 AND next_attempt <= ? "
+                "ORDER BY next_attempt LIMIT ?",
+                (time.time(), self.claim_size),
+            ).fetchall()
+            db.executemany(
+                "UPDATE post_upload SET claimed = 1 WHERE id = ?",
+                [(row[0],) for row in rows],
+            )
+            db.commit()
+            return rows
+
+        return await self._execute(_claim)
+
+    async def prune(self) -> None:
+        """Drop dead letters past their retention and the oldest beyond `maxsize`."""
+
+        def _prune(db):
+            db.execute(
+                "DELETE FROM post_upload WHERE dead = 1 AND created < ?",
+                (time.time() - self.dead_retention,),
+            )
+            db.execute(
+                "DELETE FROM post_upload WHERE id IN ("
+                "SELECT id FROM post_upload WHERE dead = 1 "
+                "ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+            db.commit()
+
+        await self._execute(_prune)
+        self._pruned = time.monotonic()
+
+    async def _deliver(self, snapshot: RequestSnapshot) -> Optional[str]:
+        """Call the hooks and return the error on failure."""
+        try:
+            results = await post_upload(snapshot)
+        except Exception as e:  # noqa: BLE001
+            return repr(e)
+        failed = [f"<{name}> : {result}" for name, ok, result in results if not ok]
+        return ", ".join(failed) or None
+
+    def _next_attempt(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2**attempts)
+        return time.time() + delay * random.uniform(0.5, 1.0)  # noqa: S311
+
+    async def _acknowledge(self, outcomes: List[Tuple[int, int, Optional[str]]]):
+        def _ack(db):
+            for event_id, attempts, error in outcomes:
+                if error is None:
+                    db.execute("DELETE FROM post_upload WHERE id = ?", (event_id,))
+                    continue
+                db.execute(
+                    "UPDATE post_upload SET claimed = 0, attempts = ?, "
+                    "next_attempt = ?, dead = ?, last_error = ? WHERE id = ?",
+                    (
+                        attempts + 1,
+                        self._next_attempt(attempts),
+                        attempts + 1 >= self.max_attempts,
+                        error,
+                        event_id,
+                    ),
+                )
+            db.commit()
+
+        await self._execute(_ack)
+
+    async def _work(self) -> None:
+        while True:
+            try:
+                batch = await self._claim()
+            except sqlite3.Error:
+                log.exception("Failed to claim post_upload events.")
+                batch = []
+
+            if not batch:
+                if time.monotonic() - self._pruned >= PRUNE_INTERVAL:
+                    try:
+                        await self.prune()
+                    except sqlite3.Error:
+                        log.exception("Failed to prune post_upload dead letters.")
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                continue
+
+            outcomes = []
+            for event_id, request, attempts in batch:
+                error = await self._deliver(RequestSnapshot.loads(request))
+                if error is None:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                    log.warning(
+                        "post_upload hooks failed (attempt {attempts}): {error}",
+                        extra={"attempts": attempts + 1, "error": error},
+                    )
+                outcomes.append((event_id, attempts, error))
+            await self._acknowledge(outcomes)
+
+    async def stats(self) -> Dict[str, float]:
+        """Return queue depth, dead letters and lag of the oldest pending event."""
+
+        def _stats(db):
+            return db.execute(
+                "SELECT "
+                "COALESCE(SUM(dead = 0), 0), "
+                "COALESCE(SUM(dead = 1), 0), "
+                "MIN(CASE WHEN dead = 0 THEN created END) "
+                "FROM post_upload",
+            ).fetchone()
+
+        depth, dead, oldest = await self._execute(_stats)
+        return {
+            "depth": depth,
+            "dead": dead,
+            "lag": time.time() - oldest if oldest is not None else 0.0,
+            "delivered": self.delivered,
+            "failed": self.failed,
+        }
+
+
+async def post_upload_queue_ctx(app: web.Application):
+    app["post_upload_queue"] = None
+    if not settings.POST_UPLOAD_QUEUE_ENABLED:
+        yield
+        return
+
+    queue = PostUploadQueue(
+        settings.POST_UPLOAD_QUEUE_PATH,
+        maxsize=settings.POST_UPLOAD_QUEUE_MAXSIZE,
+        workers=settings.POST_UPLOAD_QUEUE_WORKERS,
+        claim_size=settings.POST_UPLOAD_QUEUE_CLAIM_SIZE,
+        max_attempts=settings.POST_UPLOAD_QUEUE_MAX_ATTEMPTS,
+        dead_retention=settings.POST_UPLOAD_QUEUE_DEAD_RETENTION,
+        backoff=settings.POST_UPLOAD_QUEUE_BACKOFF,
+    )
+    await queue.open()
+    app["post_upload_queue"] = queue
+    yield
+    await queue.close()
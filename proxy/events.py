@@ -1,36 +1,179 @@
 import asyncio
-from typing import Any, ByteString, Callable, List, Optional, Tuple, Union
+import contextlib
+import functools
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import (
+    Any,
+    ByteString,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from aiohttp import web
-from pydantic import BaseModel
+from pydantic import BaseModel, NonNegativeInt, PrivateAttr
 
+from proxy.body import STREAM_CHUNK_SIZE, Body
+from proxy.cache import verdict_cache
+from proxy.conf import settings
 
-def on(event, name: Optional[str] = None, pos: Optional[int] = None):
+Hook = Tuple[
+    int,
+    str,
+    Callable[[web.Request, ...], Tuple[bool, Optional[Union[str, bytes]]]],
+]
+
+
+def on(
+    event,
+    name: Optional[str] = None,
+    pos: Optional[int] = None,
+    **options,
+):
     def _decorator(func):
-        event.register_hook(func, name or func.__name__, pos)
+        event.register_hook(func, name or func.__name__, pos, **options)
         return func
 
     return _decorator
 
 
+class HookOptions(BaseModel):
+    """Per-hook options given when registering a hook."""
+
+    # cache the verdict of the hook by content hash. Only use this for hooks
+    # whose result depends on nothing but the data, i. e. scanners.
+    cache: bool = False
+    # version of the hook that is part of the cache key. Pass a callable to
+    # derive it from e. g. the loaded virus signatures. It's called in a thread
+    # and its result is reused for `version_ttl` seconds.
+    version: Union[str, Callable[[], Any], None] = None
+    version_ttl: float = 60
+
+    # only call the hook for matching requests. Content type and size are taken
+    # from the request as sent by the client, don't rely on them to skip checks.
+    bucket: Optional[str] = None
+    prefix: Optional[str] = None
+    # glob matched against the object key, e. g. "invoices/*.pdf"
+    glob: Optional[str] = None
+    # glob matched against the content type, e. g. "image/*"
+    content_type: Optional[str] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    # how much of the payload the hook needs: "none", the first N bytes, "stream"
+    # for an iterator of chunks or "full" for the whole payload as bytes
+    data: Union[Literal["none", "stream", "full"], NonNegativeInt] = "full"
+
+    # (expiry, version) last returned by a callable `version`
+    _resolved_version: Optional[Tuple[float, str]] = PrivateAttr(default=None)
+
+    async def cache_version(self) -> Optional[str]:
+        if not callable(self.version):
+            return self.version
+        if self._resolved_version is not None:
+            expires, version = self._resolved_version
+            if time.monotonic() < expires:
+                return version
+        version = str(await asyncio.to_thread(self.version))
+        self._resolved_version = (time.monotonic() + self.version_ttl, version)
+        return version
+
+    def matches(self, target: "HookTarget") -> bool:
+        """Return whether the hook applies to `target`, apart from the bucket."""
+        key = target.key or ""
+        if self.prefix is not None and not key.startswith(self.prefix):
+            return False
+        if self.glob is not None and not fnmatchcase(key, self.glob):
+            return False
+        if self.content_type is not None and not fnmatchcase(
+            target.content_type or "",
+            self.content_type,
+        ):
+            return False
+        # an unknown size matches, the hook might be a check that mustn't be skipped
+        if target.size is None:
+            return True
+        if self.min_size is not None and target.size < self.min_size:
+            return False
+        return self.max_size is None or target.size <= self.max_size
+
+
+class HookTarget(NamedTuple):
+    """The properties of a request that hooks are matched against."""
+
+    bucket: Optional[str]
+    key: Optional[str]
+    content_type: Optional[str]
+    size: Optional[int]
+
+    @classmethod
+    def from_request(
+        cls,
+        request: web.Request,
+        data: Union[ByteString, Body, None] = None,
+    ) -> "HookTarget":
+        # unlike `extract_object_props` this keeps keys containing slashes
+        bucket, _, key = request.url.path.lstrip("/").partition("/")
+        content_type = request.headers.get("Content-Type", "").split(";")[0]
+        size = None
+        if data is not None and (not isinstance(data, Body) or data.complete):
+            size = len(data)
+        else:
+            length = request.headers.get(
+                "X-Amz-Decoded-Content-Length",
+                request.headers.get("Content-Length"),
+            )
+            with contextlib.suppress(TypeError, ValueError):
+                size = int(length)
+        return cls(
+            bucket=bucket or None,
+            key=key or None,
+            content_type=content_type.strip().lower() or None,
+            size=size,
+        )
+
+
+def _slice_data(
+    data: ByteString,
+    access: Union[str, int],
+) -> Union[ByteString, Iterator[bytes]]:
+    if access == "stream":
+        return (
+            data[offset : offset + STREAM_CHUNK_SIZE]
+            for offset in range(0, len(data), STREAM_CHUNK_SIZE)
+        )
+    if access == "full":
+        return data
+    return data[:access]
+
+
 class Event(BaseModel):
     """Represents an event that will call hooks when the event is triggered."""
 
-    hooks: List[
-        Tuple[
-            int,
-            str,
-            Callable[[web.Request, ...], Tuple[bool, Optional[Union[str, bytes]]]],
-        ]
-    ] = []
+    hooks: List[Hook] = []
+
+    hook_options: Dict[str, HookOptions] = {}
 
     blocking: bool = False
 
+    # hooks by the bucket they are restricted to, None holds unrestricted hooks
+    _index: Dict[Optional[str], List[Hook]] = PrivateAttr(default_factory=dict)
+    _indexed: Tuple[Hook, ...] = PrivateAttr(default=())
+
     def register_hook(
         self,
         hook: Callable[[web.Request, ...], Tuple[bool, Optional[Union[str, bytes]]]],
         name: str,
         pos: Optional[int] = None,
+        **options,
     ):
         """
         Register a hook for the event.
@@ -39,6 +182,7 @@ class Event(BaseModel):
         :param pos: The position of the hook. If not provided, the hook will be
                     assigned a position based on the existing hooks.
         :param name: The name of the hook, defaults to the function-name.
+        :param options: Options of the hook, see `HookOptions`.
 
         Raises
         ------
@@ -80,13 +224,120 @@ class Event(BaseModel):
             except ValueError:
                 pos = 0
 
+        self.hook_options[name] = HookOptions(**options)
         self.hooks.append((pos, name, hook))
         self.hooks = sorted(self.hooks, key=lambda x: x[0])
 
+    def _options(self, name: str) -> HookOptions:
+        return self.hook_options.get(name) or HookOptions()
+
+    def _build_index(self) -> None:
+        buckets = {self._options(name).bucket for _, name, _ in self.hooks}
+        self._index = {
+            bucket: [
+                entry
+                for entry in self.hooks
+                if self._options(entry[1]).bucket in (None, bucket)
+            ]
+            for bucket in buckets | {None}
+        }
+        self._indexed = tuple(self.hooks)
+
+    def matching_hooks(
+        self,
+        request: web.Request,
+        data: Union[ByteString, Body, None] = None,
+    ) -> List[Hook]:
+        """Return the hooks registered for the bucket, key etc. of `request`."""
+        if not self.hooks:
+            return []
+        if self._indexed != tuple(self.hooks):
+            # hooks have been registered or replaced since the last call
+            self._build_index()
+        target = HookTarget.from_request(request, data)
+        candidates = self._index.get(target.bucket, self._index[None])
+        return [
+            entry for entry in candidates if self._options(entry[1]).matches(target)
+        ]
+
+    async def _cache_key(self, name: str, hook: Callable, digest: str):
+        return (name, hook, await self._options(name).cache_version(), digest)
+
+    def _content_digest(
+        self,
+        hooks: List[Hook],
+        data: Union[ByteString, Body, None],
+    ) -> Optional[asyncio.Future]:
+        """Hash the payload once for all cached hooks, once it is complete."""
+        if data is None or not any(self._options(name).cache for _, name, _ in hooks):
+            return None
+
+        async def _digest() -> str:
+            content = await data.read() if isinstance(data, Body) else data
+            return (await asyncio.to_thread(hashlib.sha256, content)).hexdigest()
+
+        return asyncio.ensure_future(_digest())
+
+    async def _hook_data(
+        self,
+        options: HookOptions,
+        data: Union[ByteString, Body, None],
+    ) -> Union[ByteString, Iterator[bytes], None]:
+        """Return as much of the payload as the hook declared to need."""
+        if data is None or options.data == "none":
+            return None
+        if not isinstance(data, Body):
+            return _slice_data(data, options.data)
+        if options.data == "stream":
+            if self.blocking:
+                # hooks of blocking events run in the event loop that feeds the
+                # body, they mustn't block waiting for it.
+                await data.read()
+            return data.iter_chunks()
+        if options.data == "full":
+            return await data.read()
+        return await data.prefix(options.data)
+
+    async def _call_hook(
+        self,
+        name: str,
+        hook: Callable,
+        request: web.Request,
+        data: Union[ByteString, Body, None],
+        digest: Optional[asyncio.Future],
+        **kwargs,
+    ) -> Tuple[bool, Any]:
+        options = self._options(name)
+        key = None
+        if options.cache and digest is not None:
+            key = await self._cache_key(name, hook, await digest)
+            verdict = verdict_cache.get(key)
+            if verdict is not None:
+                return verdict
+
+        streaming = options.data == "stream" and isinstance(data, Body)
+        data = await self._hook_data(options, data)
+        if self.blocking:
+            verdict = hook(request, data, **kwargs)
+        elif streaming:
+            # the thread is held until the upload has been received, so these
+            # hooks get their own threads instead of the loop's default executor.
+            verdict = await asyncio.get_running_loop().run_in_executor(
+                stream_executor,
+                functools.partial(hook, request=request, data=data),
+            )
+        else:
+            verdict = await asyncio.to_thread(hook, request=request, data=data)
+        if key:
+            verdict_cache.set(key, tuple(verdict))
+        return verdict
+
     async def __call__(
         self,
         request: web.Request,
-        data: Optional[ByteString] = None,
+        data: Union[ByteString, Body, None] = None,
+        *,
+        fail_fast: bool = False,
         **kwargs,
     ) -> List[Tuple[str, bool, Any]]:
         """
@@ -99,42 +350,85 @@ class Event(BaseModel):
         due to threads where the event_loop execution of hooks would be more
         appropriate (e. g. those calling remote services).
 
+        Only hooks whose match criteria (bucket, key prefix or glob, content type
+        and size) apply to the request are called.
+
+        Verdicts of hooks registered with `cache=True` are looked up by the hash of
+        `data` first, the hook is only called on a cache miss.
+
+        `data` may be a `Body` that is still being received. Each hook gets as much
+        of it as it declared to need (see `HookOptions.data`): hooks that only need
+        a prefix are called as soon as it has arrived, streaming hooks iterate over
+        the body while it grows, and the full payload is only materialized if some
+        hook needs it.
+
         :param request (web.Request): The request parameter.
-        :param data (bytes, optional): The data parameter.
+        :param data (bytes or Body, optional): The data parameter.
+        :param fail_fast: Cancel the remaining hooks of a non-blocking event as soon
+                          as one of them fails. Only the verdicts of the hooks
+                          that finished are returned then.
 
         Returns
         -------
             List[Any]: A list of results from the hooks.
 
         """
-        if not self.hooks:
-            return self.hooks
+        hooks = self.matching_hooks(request, data)
+        if not hooks:
+            return []
+
+        digest = self._content_digest(hooks, data)
 
         if self.blocking:
             results = []
-            for _call_order_num, _name, hook in self.hooks:
-                results.append((hook.__name__, *hook(request, data, **kwargs)))
+            for _call_order_num, name, hook in hooks:
+                verdict = await self._call_hook(
+                    name,
+                    hook,
+                    request,
+                    data,
+                    digest,
+                    **kwargs,
+                )
+                results.append((hook.__name__, *verdict))
             return results
 
         tasks = [
-            asyncio.to_thread(hook, request=request, data=data)
-            for _, name, hook in self.hooks
+            asyncio.ensure_future(self._call_hook(name, hook, request, data, digest))
+            for _, name, hook in hooks
         ]
-        results = await asyncio.gather(*tasks, return_exceptions=False)
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if fail_fast and any(
+                    t.exception() is not None or not t.result()[0] for t in done
+                ):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        results = [task.result() for task in tasks if task not in pending]
+        hooks = [hook for hook, task in zip(hooks, tasks) if task not in pending]
         # NOTE: An alternative implementation would take async functions for
         # for hooks and run them in the aiohttp's event_loop. The hook itself
         # could then spawn a thread where needed, thus enhancing efficiency
         # and control. This would however require more detailed on the user's
         # side in order to achieve parallelism.
 
-        return list(
-            zip(
-                [name for _, name, _ in self.hooks],
-                [success for success, _ in results],
-                [res for _, res in results],
-            ),
-        )
+        # hooks may return further values after success and result
+        return [(name, *verdict) for (_, name, _), verdict in zip(hooks, results)]
+
 
+# threads of non-blocking hooks iterating over a body while it is received
+stream_executor = ThreadPoolExecutor(
+    max_workers=settings.HOOK_STREAM_WORKERS,
+    thread_name_prefix="stream-hook",
+)
 
 # register operations on the data that are not safe. i. e. interpreting it with
 # image processing etc.
@@ -148,3 +442,7 @@ pre_upload_before_check = Event()
 post_upload = Event()
 
 post_retrieve_data = Event()
+
+# register checks on objects copied with CopyObject. The hooks get (up to) the
+# first `COPY_PART_SIZE` bytes of the plaintext, the copy is streamed.
+pre_copy = Event()
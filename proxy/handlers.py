@@ -1,17 +1,59 @@
+import asyncio
+import contextlib
+import hmac
 import logging
-from typing import Final, Optional
+from typing import Dict, Final, Optional, Tuple, Union
 
 import aiohttp
 from aiohttp import web
+from cryptography.fernet import InvalidToken
+from multidict import CIMultiDict, CIMultiDictProxy
 from yarl import URL
 
+from proxy import sigv4
+from proxy.auth import (
+    AuthError,
+    Credentials,
+    client_credentials,
+    is_signed,
+    resign,
+    unsigned,
+)
+from proxy.body import Body
+from proxy.checksums import (
+    EXPECTED_CHECKSUM_KEY,
+    PLAINTEXT_CHECKSUM_HEADER,
+    Checksums,
+    format_checksum,
+    is_checksum_header,
+    parse_checksum,
+    replace_checksum_headers,
+    requested_algorithms,
+    stored_algorithm,
+)
+from proxy.chunked import (
+    AwsChunkedError,
+    is_aws_chunked,
+    iter_payload,
+    strip_aws_chunked_headers,
+)
+from proxy.ciphers import VerifyingDecryptor, plaintext_size
 from proxy.conf import settings
+from proxy.copy import (
+    CopyError,
+    CopyRejectedError,
+    ObjectCopy,
+    copy_result,
+    is_copy_request,
+)
 from proxy.events import (
     post_retrieve_data,
     post_upload,
     pre_upload_before_check,
     pre_upload_unsafe,
 )
+from proxy.listing import PLAINTEXT_SIZE_HEADER, SizeRewriter, is_list_request
+from proxy.ranged import fetch_ranged, object_size, open_ranged, use_ranged_fetch
 from proxy.utils import extract_object_props, make_error_response
 
 log = logging.getLogger("aiohttp.server")
@@ -20,38 +62,61 @@ log = logging.getLogger("aiohttp.server")
 routes: Final = web.RouteTableDef()
 
 
-def to_response(client_resp: aiohttp.ClientResponse, content=None) -> web.Response:
-    """Create a server response from the client response."""
-
-    interesting_headers = [
+# upstream response headers passed on to the client, lower case
+RESPONSE_HEADERS: Final = frozenset(
+    h.lower()
+    for h in (
         "Cookie",
         "Host",
         "Referer",
         "User-Agent",
         "Accept",
         "Accept-Language",
-    ]
+        PLAINTEXT_CHECKSUM_HEADER,
+    )
+)
+
 
-    headers = {
-        k: client_resp.headers[k]
-        for k in interesting_headers
-        if k in client_resp.headers
+def response_headers(client_resp: aiohttp.ClientResponse) -> Dict[str, str]:
+    """Filter the headers of the client response in a single pass."""
+    return {
+        k: v for k, v in client_resp.headers.items() if k.lower() in RESPONSE_HEADERS
     }
-    if content:
-        headers["Content-Length"] = str(len(content))
 
+
+def to_response(
+    client_resp: aiohttp.ClientResponse,
+    content: Optional[bytes] = None,
+    status: Optional[int] = None,
+) -> web.Response:
+    """
+    Create a server response from the client response.
+
+    The content is passed on as is, aiohttp derives the `Content-Length` from it.
+    """
     return web.Response(
         body=content,
-        status=client_resp.status,
-        headers=headers,
-        reason=client_resp.reason,
+        status=status or client_resp.status,
+        headers=response_headers(client_resp),
+        reason=None if status else client_resp.reason,
+    )
+
+
+def get_upstream_host() -> URL:
+    return URL.build(
+        scheme="https" if settings.OBJECT_STORE_SSL_ENABLED else "http",
+        host=settings.OBJECT_STORE_HOST,
+        port=settings.OBJECT_STORE_PORT,
     )
 
 
 async def proxy_pass(
     request: web.Request,
-    data: Optional[bytes] = None,
-) -> web.Response:
+    data: Union[bytes, memoryview, None] = None,
+    headers: Optional[CIMultiDict] = None,
+    rewriter: Optional[SizeRewriter] = None,
+    credentials: Optional[Credentials] = None,
+) -> web.StreamResponse:
     """
     Make a proxied HTTP request to a s3 object storage service.
 
@@ -59,30 +124,53 @@ async def proxy_pass(
                                   request to be proxied.
     :param data (optional): The data to be sent in the request body. It is used for
                             PUT requests.
+    :param headers (optional): The headers to send upstream. Defaults to the
+                               headers of `request`.
+    :param rewriter (optional): Stream the response body through this rewriter
+                                instead of buffering it.
+    :param credentials (optional): Sign the request again with the client's
+                                   credentials, because `data` or `headers`
+                                   differ from what the client signed.
 
     Returns
     -------
         web.Response: The response object representing the result of the proxied HTTP
                       request.
     """
-    upstream_host = URL.build(
-        scheme="https" if settings.OBJECT_STORE_SSL_ENABLED else "http",
-        host=settings.OBJECT_STORE_HOST,
-        port=settings.OBJECT_STORE_PORT,
-    )
-
-    headers = request.headers.copy()
-    if data:
+    upstream_host = get_upstream_host()
+    # the client session copies the headers anyway, they're only copied here if
+    # the body changed its length.
+    headers = request.headers if headers is None else headers
+    if data is not None and headers.get("Content-Length") != str(len(data)):
+        if isinstance(headers, CIMultiDictProxy):
+            headers = headers.copy()
         headers["Content-Length"] = str(len(data))
-    make_request = getattr(request.app["client_session"], request.method.lower())
-    async with make_request(
-        str(upstream_host.joinpath(request.path.lstrip("/"))),
-        headers=headers,
-        data=data,
-        params=request.query,
-        # proxy=upstream_host,
-    ) as resp:
+    url = str(upstream_host.joinpath(request.path.lstrip("/")))
+    params = request.query
+    if credentials is not None:
+        url = resign(request, credentials, URL(url).with_query(params), headers)
+        params = None
+    upstream = request.app["upstream"]
+    if rewriter is None and use_ranged_fetch(request):
+        resp, content = await fetch_ranged(
+            upstream,
+            request.app["client_session"],
+            url,
+            headers,
+            request.query,
+        )
+        # the client asked for the whole object, not the first range
+        partial = resp.status == web.HTTPPartialContent.status_code
+        return to_response(
+            resp,
+            content=content,
+            status=web.HTTPOk.status_code if partial else None,
+        )
+
+    async def consume(resp: aiohttp.ClientResponse) -> web.StreamResponse:
         resp.raise_for_status()
+        if rewriter is not None:
+            return await stream_response(request, resp, rewriter)
         content = await resp.read()
         log.debug(
             "Proxy passing request {request} to {upstream_host}. Result: {resp}",
@@ -94,13 +182,256 @@ async def proxy_pass(
         )
         return to_response(resp, content=content)
 
+    return await upstream.request(
+        request.app["client_session"],
+        request.method,
+        url,
+        consume,
+        headers=headers,
+        data=data,
+        params=params,
+    )
+
+
+async def stream_response(
+    request: web.Request,
+    client_resp: aiohttp.ClientResponse,
+    rewriter: SizeRewriter,
+) -> web.StreamResponse:
+    """Stream the client response to the client, rewriting it on the way."""
+    response = web.StreamResponse(
+        status=client_resp.status,
+        reason=client_resp.reason,
+        headers=response_headers(client_resp),
+    )
+    response.content_type = client_resp.content_type
+    await response.prepare(request)
+    try:
+        async for chunk in client_resp.content.iter_any():
+            await response.write(rewriter.feed(chunk))
+    except aiohttp.ClientConnectionError as e:
+        # the response has been started, so the request can't be retried anymore
+        raise aiohttp.ClientPayloadError(str(e)) from e
+    await response.write(rewriter.close())
+    await response.write_eof()
+    return response
+
+
+def encryption_enabled() -> bool:
+    return any(
+        name == "hook_encrypt_data" for _, name, _ in pre_upload_before_check.hooks
+    )
+
+
+async def handle_list(request: web.Request) -> web.StreamResponse:
+    """Stream a bucket listing, reporting plaintext instead of ciphertext sizes."""
+    estimate = encryption_enabled() and settings.LISTING_SIZE_ESTIMATE_ENABLED
+    rewriter = SizeRewriter(plaintext_size if estimate else None)
+    return await proxy_pass(request, rewriter=rewriter)
+
+
+# request headers that change the result of a GET. Concurrent GETs are only
+# coalesced if they agree on all of them. The credentials aren't among them, every
+# client joining a GET is authorized on its own (see `authorize`).
+COALESCING_HEADERS: Final = (
+    "Host",
+    "Range",
+    "If-Match",
+    "If-None-Match",
+    "If-Modified-Since",
+    "If-Unmodified-Since",
+    "X-Amz-Request-Payer",
+    "X-Amz-Expected-Bucket-Owner",
+    "X-Amz-Checksum-Mode",
+    "X-Amz-Server-Side-Encryption-Customer-Algorithm",
+    "X-Amz-Server-Side-Encryption-Customer-Key",
+    "X-Amz-Server-Side-Encryption-Customer-Key-Md5",
+)
+
+# query parameters of presigned URLs, they don't change the result either.
+PRESIGNED_PARAMETERS: Final = frozenset(
+    {
+        "X-Amz-Algorithm",
+        "X-Amz-Credential",
+        "X-Amz-Date",
+        "X-Amz-Expires",
+        "X-Amz-Security-Token",
+        "X-Amz-Signature",
+        "X-Amz-SignedHeaders",
+    },
+)
+
+
+def coalescing_key(request: web.Request) -> tuple:
+    return (
+        request.path,
+        tuple(
+            sorted(
+                (name, value)
+                for name, value in request.query.items()
+                if name not in PRESIGNED_PARAMETERS
+            ),
+        ),
+        *(tuple(request.headers.getall(h, ())) for h in COALESCING_HEADERS),
+    )
+
+
+async def authorize(request: web.Request) -> Optional[web.Response]:
+    """
+    Check that upstream lets the client read the object with its own credentials.
+
+    A client joining a coalesced GET would otherwise get an object fetched with
+    someone else's credentials. Its request is sent upstream as it was signed,
+    only limited to the first byte if it isn't ranged already (an unsigned Range
+    header doesn't invalidate the signature). Returns the error response if
+    upstream denies access.
+    """
+    headers = request.headers
+    if "Range" not in headers:
+        headers = headers.copy()
+        headers["Range"] = "bytes=0-0"
+
+    async def consume(resp: aiohttp.ClientResponse) -> Tuple[int, str]:
+        return resp.status, resp.reason
+
+    status, reason = await request.app["upstream"].request(
+        request.app["client_session"],
+        "GET",
+        str(get_upstream_host().joinpath(request.path.lstrip("/"))),
+        consume,
+        headers=headers,
+        params=request.query,
+    )
+    if status in (web.HTTPUnauthorized.status_code, web.HTTPForbidden.status_code):
+        return web.Response(status=status, reason=reason)
+    return None
+
 
 async def handle_get(request: web.Request) -> web.Response:
+    """
+    Handle download of an object.
+
+    Concurrent GETs for the same object (and the same headers affecting the result)
+    share a single upstream fetch and decryption. Each waiter gets its own response
+    around the shared body, a response can only be sent once. Waiters that didn't
+    start the fetch are authorized upstream meanwhile, and fetch the object
+    themselves if upstream denied it to the client that did.
+    """
+    if is_list_request(request):
+        return await handle_list(request)
+
+    if streams_ranged(request):
+        # the object is passed on as it arrives, there's no body to share
+        return await retrieve_ranged(request)
+
+    single_flight = request.app.get("single_flight")
+    if single_flight is None:
+        return await retrieve(request)
+
+    key = coalescing_key(request)
+    if key not in single_flight:
+        response = await single_flight.do(key, lambda: retrieve(request))
+    else:
+        denied, response = await asyncio.gather(
+            authorize(request),
+            single_flight.do(key, lambda: retrieve(request)),
+            return_exceptions=True,
+        )
+        if isinstance(denied, BaseException):
+            raise denied
+        if denied is not None:
+            return denied
+        if isinstance(response, aiohttp.ClientResponseError) and response.status < 500:
+            # the client that started the fetch was denied, this one wasn't
+            response = await retrieve(request)
+        elif isinstance(response, BaseException):
+            raise response
+    return web.Response(
+        body=response.body,
+        status=response.status,
+        reason=response.reason,
+        headers=response.headers,
+    )
+
+
+def decryption_enabled() -> bool:
+    return any(name == "hook_decrypt_data" for _, name, _ in post_retrieve_data.hooks)
+
+
+def streams_ranged(request: web.Request) -> bool:
+    """
+    Return whether the object is streamed to the client in ranges.
+
+    That's only possible if no `post_retrieve_data` hook but the decryption needs
+    the whole object.
+    """
+    return use_ranged_fetch(request) and all(
+        name == "hook_decrypt_data" for _, name, _ in post_retrieve_data.hooks
+    )
+
+
+async def retrieve_ranged(request: web.Request) -> web.StreamResponse:
+    """
+    Stream the object to the client in ranges, decrypting them as they arrive.
+
+    Only the ranges being fetched are held in memory. The token and the plaintext
+    checksum can only be verified after the last range though: if they don't
+    match, the connection is closed before the response is complete.
+    """
+    first, parts = await open_ranged(
+        request.app["upstream"],
+        request.app["client_session"],
+        str(get_upstream_host().joinpath(request.path.lstrip("/"))),
+        request.headers,
+        request.query,
+    )
+    # the client asked for the whole object, not the first range
+    partial = first.status == web.HTTPPartialContent.status_code
+    response = web.StreamResponse(
+        status=web.HTTPOk.status_code if partial else first.status,
+        reason=None if partial else first.reason,
+        headers=response_headers(first),
+    )
+    decryptor = None
+    if decryption_enabled() and object_size(first):
+        decryptor = VerifyingDecryptor(
+            extract_object_props(request).name,
+            parse_checksum(first.headers.get(PLAINTEXT_CHECKSUM_HEADER)),
+        )
+        size = first.headers.get(PLAINTEXT_SIZE_HEADER)
+        response.content_length = int(size) if size else None
+    else:
+        response.content_length = object_size(first)
+
+    await response.prepare(request)
+    async with contextlib.aclosing(parts):
+        try:
+            async for part in parts:
+                if decryptor is not None:
+                    part = await asyncio.to_thread(decryptor.feed, part)
+                await response.write(part)
+            if decryptor is not None:
+                await response.write(decryptor.close())
+        except (InvalidToken, aiohttp.ClientError) as e:
+            log.warning(
+                "Aborting download of {s3obj}: {error}",
+                extra={"s3obj": extract_object_props(request), "error": e},
+            )
+            request.protocol.force_close()
+            return response
+    await response.write_eof()
+    return response
+
+
+async def retrieve(request: web.Request) -> web.Response:
     response = await proxy_pass(request)
     s3obj = extract_object_props(request)
     content = response.body
     if content and s3obj is not None:
         log.debug("Decrypting {s3obj} ..", extra={"s3obj": s3obj})
+        request[EXPECTED_CHECKSUM_KEY] = parse_checksum(
+            response.headers.get(PLAINTEXT_CHECKSUM_HEADER),
+        )
         results = await post_retrieve_data(request, content)
         if not all(res[1] for res in results):
             return make_error_response(
@@ -110,8 +441,82 @@ async def handle_get(request: web.Request) -> web.Response:
             )
         decrypted = next(filter(lambda x: x[0] == "hook_decrypt_data", results), None)
         if decrypted:
-            content = decrypted[2]
-    return to_response(response, content=content)
+            # the response built by proxy_pass is reused, only its body changes
+            response.body = decrypted[2]
+    return response
+
+
+async def _receive(request: web.Request, body: Body) -> None:
+    try:
+        async for piece in iter_payload(request):
+            body.feed(piece)
+    except BaseException as e:
+        body.abort(e)
+        raise
+    body.close()
+
+
+async def receive_checked(request: web.Request) -> Tuple[Body, list]:
+    """
+    Receive the upload while the `pre_upload_before_check` hooks run on it.
+
+    The hooks are started right away, hooks that only need a prefix of the body
+    don't have to wait for the whole upload. If one of them rejects the upload,
+    the rest of it isn't received.
+    """
+    body = Body()
+    checks = asyncio.ensure_future(
+        pre_upload_before_check(request, body, fail_fast=True),
+    )
+    receiving = asyncio.ensure_future(_receive(request, body))
+    try:
+        await asyncio.wait([checks, receiving], return_when=asyncio.FIRST_COMPLETED)
+        if not receiving.done() and not all(res[1] for res in checks.result()):
+            receiving.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await receiving
+            return body, checks.result()
+        await receiving
+        return body, await checks
+    except BaseException:
+        checks.cancel()
+        receiving.cancel()
+        await asyncio.gather(checks, receiving, return_exceptions=True)
+        raise
+
+
+async def close_unread(request: web.Request, response: web.StreamResponse) -> None:
+    """
+    Send `response` and close the connection without reading the rest of the body.
+
+    Otherwise aiohttp would keep reading (and discarding) an upload that was
+    already rejected.
+    """
+    response.force_close()
+    await response.prepare(request)
+    await response.write_eof()
+    request.protocol.force_close()
+
+
+async def receive_upload(
+    request: web.Request,
+) -> Tuple[Body, list, Optional[Credentials]]:
+    """
+    Receive an upload like `receive_checked`.
+
+    aws-chunked uploads are decoded before they are passed upstream, so they are
+    only accepted from anonymous clients or clients the proxy can sign them for.
+    Encrypted uploads get other checksums and metadata only if the proxy can sign
+    them, otherwise they are passed on as the client signed them. The credentials
+    of the client are returned if they are known.
+    """
+    credentials = None
+    if is_aws_chunked(request):
+        credentials = client_credentials(request)
+    elif encryption_enabled():
+        credentials = client_credentials(request, required=False)
+    body, results = await receive_checked(request)
+    return body, results, credentials
 
 
 async def handle_put(request: web.Request) -> web.Response:
@@ -142,30 +547,51 @@ async def handle_put(request: web.Request) -> web.Response:
             reason="Failed to get bucket and object-id from upload request.",
         )
 
-    content = await request.content.read()
     log.debug(
         "Hooks to be called by pre_upload_before_check: {hooks}.",
         extra={"hooks": pre_upload_before_check},
     )
-    results = await pre_upload_before_check(request, content)
+    try:
+        body, results, credentials = await receive_upload(request)
+    except (AuthError, AwsChunkedError) as e:
+        return web.Response(
+            status=getattr(e, "status", web.HTTPBadRequest.status_code),
+            reason=f"Failed to receive upload. {e}",
+        )
+
+    headers = None
+    if is_aws_chunked(request):
+        headers = strip_aws_chunked_headers(request.headers)
+
     if not all(res[1] for res in results):
-        return make_error_response(
+        response = make_error_response(
             results,
             "Pre-upload hook failed",
             status_code=400,
         )
-    encrypted = content
+        if not body.complete:
+            await close_unread(request, response)
+        return response
+    # the body is only copied if a hook needs it as bytes
+    encrypted = body.getbuffer()
     encrypted_result = next(
         filter(lambda x: x[0] == "hook_encrypt_data", results),
         None,
     )
     if encrypted_result:
         encrypted = encrypted_result[2]
+        headers = encrypted_upload_headers(
+            request,
+            request.headers.copy() if headers is None else headers,
+            len(body),
+            encrypted_result,
+            signable=credentials is not None or not is_signed(request),
+        )
 
     # perform additional checks after pre-upload hook that are not considered safe
     # before checks above
     log.debug("Hooks pre_upload_unsafe: {hooks}", extra={"hooks": pre_upload_unsafe})
-    check_results = await pre_upload_unsafe(request, data=content)
+    check_results = await pre_upload_unsafe(request, data=body)
 
     if not all(res[1] for res in check_results):
         return make_error_response(
@@ -174,13 +600,117 @@ async def handle_put(request: web.Request) -> web.Response:
             status_code=400,
         )
 
-    response = await proxy_pass(request, data=encrypted)
+    response = await proxy_pass(
+        request,
+        data=encrypted,
+        headers=headers,
+        credentials=credentials,
+    )
 
     if response.status < 400:
-        await post_upload(request)
+        await notify_uploaded(request)
     return response
 
 
+def encrypted_upload_headers(
+    request: web.Request,
+    headers: CIMultiDict,
+    size: int,
+    encrypted_result: tuple,
+    *,
+    signable: bool,
+) -> CIMultiDict:
+    """
+    Adapt the headers of an upload to its ciphertext.
+
+    If the upload isn't `signable` by the proxy, headers can't be added. Only the
+    plaintext checksums the client didn't sign are dropped then.
+    """
+    if not signable:
+        checksum_headers = [h for h in headers if is_checksum_header(h)]
+        for header in unsigned(request, checksum_headers):
+            headers.popall(header, None)
+        return headers
+    # keep the plaintext size for listings
+    headers[PLAINTEXT_SIZE_HEADER] = str(size)
+    # the client's checksums and payload hash are those of the plaintext
+    headers["X-Amz-Content-Sha256"] = sigv4.UNSIGNED_PAYLOAD
+    if len(encrypted_result) > 3:
+        set_checksum_headers(request, headers, encrypted_result[3])
+    return headers
+
+
+def set_checksum_headers(
+    request: web.Request,
+    headers: CIMultiDict,
+    checksums: Checksums,
+) -> None:
+    """Send the checksums of the ciphertext, store the plaintext's as metadata."""
+    replace_checksum_headers(headers, checksums.ciphertext)
+    algorithm = stored_algorithm(requested_algorithms(request.headers))
+    headers[PLAINTEXT_CHECKSUM_HEADER] = format_checksum(
+        algorithm,
+        checksums.plaintext[algorithm],
+    )
+
+
+async def notify_uploaded(request: web.Request) -> None:
+    """Call the post_upload hooks, from the queue if it is enabled."""
+    queue = request.app.get("post_upload_queue")
+    if queue is None or not await queue.put(request):
+        await post_upload(request)
+
+
+async def handle_copy(request: web.Request) -> web.Response:
+    """
+    Handle CopyObject.
+
+    Without encryption the copy is left to the object store. Otherwise the source
+    is streamed through the proxy and re-encrypted for the destination, on behalf
+    of the client whose credentials must be known to the proxy.
+    """
+    if not encryption_enabled():
+        return await proxy_pass(request)
+
+    try:
+        copy = ObjectCopy.from_request(request, get_upstream_host())
+        etag = await copy.run()
+    except CopyRejectedError as e:
+        return make_error_response(e.results, "Copy rejected.", status_code=400)
+    except CopyError as e:
+        return web.Response(status=e.status, reason=str(e))
+    except aiohttp.ClientResponseError as e:
+        return web.Response(
+            status=e.status,
+            reason=f"Failed to read copy source. {e.message}",
+        )
+
+    await notify_uploaded(request)
+    return web.Response(body=copy_result(etag), content_type="application/xml")
+
+
+# bucket names can't start with an underscore, so this doesn't shadow any bucket.
+@routes.get("/_proxy/stats")
+async def handle_stats(request: web.Request) -> web.Response:
+    """Report upstream and queue stats to clients presenting `PROXY_STATS_TOKEN`."""
+    if settings.STATS_TOKEN is None:
+        return web.Response(status=404, reason="Stats are disabled.")
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(),
+        f"Bearer {settings.STATS_TOKEN}".encode(),
+    ):
+        return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+
+    stats = {}
+    balancer = request.app["upstream"].balancer
+    if balancer is not None:
+        stats["upstream_endpoints"] = balancer.stats()
+    queue = request.app.get("post_upload_queue")
+    if queue is not None:
+        stats["post_upload_queue"] = await queue.stats()
+    return web.json_response(stats)
+
+
 @routes.view(r"/{tail:.*}")
 async def handle(request: web.Request) -> web.Response:
     if request.method not in ["GET", "PUT"]:
@@ -202,6 +732,9 @@ async def handle(request: web.Request) -> web.Response:
     if request.method == "GET":
         return await handle_get(request)
 
+    if is_copy_request(request):
+        return await handle_copy(request)
+
     if request.method == "PUT":
         return await handle_put(request)
 
@@ -0,0 +1,144 @@
+"""
+Streaming rewrite of object listings.
+
+Objects are stored encrypted, so the `<Size>` reported by ListObjects(V2) and
+ListObjectVersions is the size of the ciphertext. `SizeRewriter` replaces it with
+the plaintext size while the listing streams through the proxy. Only a single
+`<Contents>`/`<Version>` entry is held in memory at a time.
+"""
+import re
+from pathlib import Path
+from typing import Callable, Final, Optional
+
+from aiohttp import web
+
+# stored as user metadata of encrypted objects on upload
+PLAINTEXT_SIZE_HEADER: Final = "X-Amz-Meta-Plaintext-Size"
+
+# bucket subresources that are GET requests on the bucket but not listings
+BUCKET_SUBRESOURCES: Final = frozenset(
+    [
+        "accelerate",
+        "acl",
+        "analytics",
+        "cors",
+        "encryption",
+        "intelligent-tiering",
+        "inventory",
+        "lifecycle",
+        "location",
+        "logging",
+        "metrics",
+        "notification",
+        "object-lock",
+        "ownershipControls",
+        "policy",
+        "policyStatus",
+        "publicAccessBlock",
+        "replication",
+        "requestPayment",
+        "tagging",
+        "versioning",
+        "website",
+    ],
+)
+
+_entry_open_re: Final = re.compile(rb"<(Contents|Version)>")
+_size_re: Final = re.compile(rb"<Size>(\d+)</Size>")
+_metadata_size_re: Final = re.compile(
+    rb"<(%s)>(\d+)</\1>" % PLAINTEXT_SIZE_HEADER.encode(),
+    re.IGNORECASE,
+)
+# the longest tag that may be split across two chunks
+_TAIL: Final = len(b"</Contents>") - 1
+
+
+def is_list_request(request: web.Request) -> bool:
+    """Return whether `request` lists the objects of a bucket."""
+    parts = Path(request.url.path).parts
+    return (
+        request.method == "GET"
+        and len(parts) == 2
+        and not BUCKET_SUBRESOURCES.intersection(request.query)
+    )
+
+
+class SizeRewriter:
+    """
+    Incrementally replace `<Size>` of listing entries with plaintext sizes.
+
+    The plaintext size is taken from the `X-Amz-Meta-Plaintext-Size` user metadata
+    if the listing includes it. Otherwise it is derived from the ciphertext size by
+    `plaintext_size`, if given.
+
+    :param plaintext_size: Callable returning the plaintext size for a ciphertext
+                           size.
+    :param max_entry_size: Entries larger than this are passed through unchanged
+                           rather than buffered.
+    """
+
+    def __init__(
+        self,
+        plaintext_size: Optional[Callable[[int], int]] = None,
+        max_entry_size: int = 64 * 1024,
+    ) -> None:
+        self.plaintext_size = plaintext_size
+        self.max_entry_size = max_entry_size
+        self._buf = bytearray()
+        self._closing_tag: Optional[bytes] = None
+        self._overflow = False
+
+    def feed(self, data: bytes) -> bytes:
+        self._buf += data
+        out = bytearray()
+        while True:
+            if self._closing_tag is None:
+                match = _entry_open_re.search(self._buf)
+                if match is None:
+                    keep = min(len(self._buf), _TAIL)
+                    out += self._buf[: len(self._buf) - keep]
+                    del self._buf[: len(self._buf) - keep]
+                    return bytes(out)
+                self._closing_tag = b"</%s>" % match[1]
+                out += self._buf[: match.start()]
+                del self._buf[: match.start()]
+                continue
+
+            end = self._buf.find(self._closing_tag)
+            if end < 0:
+                if len(self._buf) > self.max_entry_size:
+                    # give up on this entry, keep memory bounded
+                    self._overflow = True
+                    keep = len(self._closing_tag) - 1
+                    out += self._buf[: len(self._buf) - keep]
+                    del self._buf[: len(self._buf) - keep]
+                return bytes(out)
+
+            end += len(self._closing_tag)
+            entry = bytes(self._buf[:end])
+            del self._buf[:end]
+            out += entry if self._overflow else self._rewrite(entry)
+            self._closing_tag = None
+            self._overflow = False
+
+    def close(self) -> bytes:
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
+
+    def _rewrite(self, entry: bytes) -> bytes:
+        metadata = _metadata_size_re.search(entry)
+        if metadata is not None:
+            size = int(metadata[2])
+        elif self.plaintext_size is not None:
+            match = _size_re.search(entry)
+            if match is None:
+                return entry
+            try:
+                size = self.plaintext_size(int(match[1]))
+            except ValueError:
+                # not encrypted by the proxy
+                return entry
+        else:
+            return entry
+        return _size_re.sub(b"<Size>%d</Size>" % size, entry, count=1)
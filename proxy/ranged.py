@@ -0,0 +1,217 @@
+"""
+Parallel ranged fetch of large objects.
+
+A single upstream connection caps the throughput of a download. For objects above
+a threshold the object is fetched as several ranges over concurrent connections
+of the pooled `ClientSession` and passed on in order. Only a few ranges are
+fetched ahead of the consumer, so large objects aren't held in memory.
+
+The first range doubles as a probe for the object size: objects that fit into it
+are served with a single request.
+"""
+import asyncio
+import contextlib
+import itertools
+import re
+from collections import deque
+from typing import AsyncIterator, Deque, Final, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+
+from proxy.conf import settings
+from proxy.resilience import Upstream
+from proxy.utils import extract_object_props
+
+# object subresources that must not be fetched in ranges
+OBJECT_SUBRESOURCES: Final = frozenset(
+    [
+        "acl",
+        "attributes",
+        "legal-hold",
+        "partNumber",
+        "retention",
+        "tagging",
+        "torrent",
+    ],
+)
+
+_content_range_re: Final = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+def parse_content_range(value: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    """Parse a `Content-Range` header into start, end and total size."""
+    match = _content_range_re.match(value or "")
+    if match is None:
+        return None
+    return int(match[1]), int(match[2]), int(match[3])
+
+
+def split_ranges(start: int, total: int, part_size: int) -> List[Tuple[int, int]]:
+    """Split the bytes from `start` to `total` into inclusive ranges."""
+    return [
+        (offset, min(offset + part_size, total) - 1)
+        for offset in range(start, total, part_size)
+    ]
+
+
+def use_ranged_fetch(request: web.Request) -> bool:
+    return (
+        settings.RANGED_FETCH_ENABLED
+        and request.method == "GET"
+        and "Range" not in request.headers
+        and extract_object_props(request) is not None
+        and not OBJECT_SUBRESOURCES.intersection(request.query)
+    )
+
+
+async def _read(resp: aiohttp.ClientResponse) -> Tuple[aiohttp.ClientResponse, bytes]:
+    if resp.status != web.HTTPRequestRangeNotSatisfiable.status_code:
+        resp.raise_for_status()
+    return resp, await resp.read()
+
+
+async def _fetch_range(
+    upstream: Upstream,
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: CIMultiDict,
+    params,
+    byte_range: Tuple[int, int],
+) -> bytes:
+    headers = headers.copy()
+    headers["Range"] = "bytes={}-{}".format(*byte_range)
+    resp, content = await upstream.request(
+        session,
+        "GET",
+        url,
+        _read,
+        headers=headers,
+        params=params,
+    )
+    if resp.status != web.HTTPPartialContent.status_code:
+        msg = f"Expected partial content for range {byte_range}"
+        raise aiohttp.ClientPayloadError(msg)
+    return content
+
+
+async def _iter_ranges(
+    upstream: Upstream,
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: CIMultiDict,
+    params,
+    content: bytes,
+    ranges: List[Tuple[int, int]],
+) -> AsyncIterator[bytes]:
+    """Yield `content` and the ranges in order, fetching only a few of them ahead."""
+    yield content
+    remaining = iter(ranges)
+    pending: Deque[asyncio.Task] = deque()
+
+    def fetch_next(count: int = 1) -> None:
+        pending.extend(
+            asyncio.create_task(
+                _fetch_range(upstream, session, url, headers, params, byte_range),
+            )
+            for byte_range in itertools.islice(remaining, count)
+        )
+
+    try:
+        fetch_next(settings.RANGED_FETCH_CONCURRENCY)
+        while pending:
+            part = await pending.popleft()
+            fetch_next()
+            yield part
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _single(content: bytes) -> AsyncIterator[bytes]:
+    yield content
+
+
+def object_size(first: aiohttp.ClientResponse) -> Optional[int]:
+    """Return the size of the object from the response to the first range."""
+    content_range = parse_content_range(first.headers.get("Content-Range"))
+    if content_range is not None:
+        return content_range[2]
+    return first.content_length
+
+
+async def open_ranged(
+    upstream: Upstream,
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: CIMultiDict,
+    params,
+) -> Tuple[aiohttp.ClientResponse, AsyncIterator[bytes]]:
+    """
+    Start fetching an object in ranges over concurrent connections.
+
+    Returns the (released) response of the first range, whose headers describe the
+    object, and an iterator over the content of the whole object. At most
+    `RANGED_FETCH_CONCURRENCY` ranges are fetched ahead of the consumer, the
+    iterator must be closed if it isn't exhausted.
+    """
+    part_size = settings.RANGED_FETCH_PART_SIZE
+    headers = headers.copy()
+    headers["Range"] = f"bytes=0-{part_size - 1}"
+    first, content = await upstream.request(
+        session,
+        "GET",
+        url,
+        _read,
+        headers=headers,
+        params=params,
+    )
+    if first.status == web.HTTPRequestRangeNotSatisfiable.status_code:
+        # empty objects can't be fetched in ranges
+        del headers["Range"]
+        first, content = await upstream.request(
+            session,
+            "GET",
+            url,
+            _read,
+            headers=headers,
+            params=params,
+        )
+        return first, _single(content)
+
+    content_range = parse_content_range(first.headers.get("Content-Range"))
+    if first.status != web.HTTPPartialContent.status_code or content_range is None:
+        # upstream ignored the range and sent the whole object
+        return first, _single(content)
+
+    total = content_range[2]
+    if total <= len(content):
+        return first, _single(content)
+
+    # make sure all ranges are from the same version of the object
+    if "ETag" in first.headers and "If-Match" not in headers:
+        headers["If-Match"] = first.headers["ETag"]
+    if total < settings.RANGED_FETCH_THRESHOLD:
+        ranges = [(len(content), total - 1)]
+    else:
+        ranges = split_ranges(len(content), total, part_size)
+    return first, _iter_ranges(upstream, session, url, headers, params, content, ranges)
+
+
+async def fetch_ranged(
+    upstream: Upstream,
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: CIMultiDict,
+    params,
+) -> Tuple[aiohttp.ClientResponse, bytes]:
+    """
+    Fetch a whole object in ranges like `open_ranged`.
+
+    This holds the whole object in memory, only use it if it's needed as a whole.
+    """
+    first, parts = await open_ranged(upstream, session, url, headers, params)
+    async with contextlib.aclosing(parts):
+        return first, b"".join([part async for part in parts])
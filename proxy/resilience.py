@@ -0,0 +1,286 @@
+"""
+Retries and hedging for requests to the object store.
+
+Idempotent requests that fail with a connection error, a timeout or a 5xx status
+are retried with jittered exponential backoff. Request bodies are buffered before
+they're sent upstream, so PUTs can simply be replayed.
+
+GET and HEAD requests are additionally hedged: if the response headers haven't
+arrived after the configured percentile of recent upstream latencies, a second
+attempt is started and whichever responds first wins. The other one is cancelled.
+
+With several object store endpoints the attempts are spread over them by a
+`Balancer`, retries and hedges prefer an endpoint that hasn't been tried yet.
+"""
+import asyncio
+import logging
+import random
+from collections import deque
+from typing import Awaitable, Callable, Final, List, NamedTuple, Optional, TypeVar
+
+import aiohttp
+from aiohttp.typedefs import StrOrURL
+
+from proxy.balancer import Balancer, Endpoint
+from proxy.conf import settings
+
+log = logging.getLogger("aiohttp.server")
+
+T = TypeVar("T")
+
+IDEMPOTENT_METHODS: Final = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+HEDGED_METHODS: Final = frozenset(["GET", "HEAD"])
+RETRY_STATUSES: Final = frozenset([500, 502, 503, 504])
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+class LatencyTracker:
+    """Sliding window of the latest upstream latencies."""
+
+    def __init__(self, window: int = 1000, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """Return the latency percentile, or None without enough samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        index = round(percentile / 100 * (len(samples) - 1))
+        return samples[index]
+
+
+class Attempt(NamedTuple):
+    response: aiohttp.ClientResponse
+    endpoint: Optional[Endpoint]
+
+
+class Upstream:
+    def __init__(
+        self,
+        retries: int = 2,
+        backoff: float = 0.05,
+        max_backoff: float = 1.0,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_delay: float = 0.0,
+        balancer: Optional[Balancer] = None,
+    ) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+        self.balancer = balancer
+
+    @classmethod
+    def from_settings(cls) -> "Upstream":
+        balancer = None
+        if settings.OBJECT_STORE_ENDPOINTS:
+            balancer = Balancer(
+                settings.OBJECT_STORE_ENDPOINTS,
+                strategy=settings.UPSTREAM_BALANCING,
+                max_failures=settings.UPSTREAM_MAX_FAILURES,
+                ejection_time=settings.UPSTREAM_EJECTION_TIME,
+                pool_size=settings.UPSTREAM_POOL_SIZE,
+            )
+        return cls(
+            retries=settings.UPSTREAM_RETRIES,
+            backoff=settings.UPSTREAM_RETRY_BACKOFF,
+            connect_timeout=settings.UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout=settings.UPSTREAM_READ_TIMEOUT,
+            hedge_percentile=settings.UPSTREAM_HEDGE_PERCENTILE,
+            hedge_min_delay=settings.UPSTREAM_HEDGE_MIN_DELAY,
+            balancer=balancer,
+        )
+
+    async def open(self) -> None:
+        if self.balancer is not None:
+            await self.balancer.open()
+
+    async def close(self) -> None:
+        if self.balancer is not None:
+            await self.balancer.close()
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile is None:
+            return None
+        latency = self.latency.percentile(self.hedge_percentile)
+        if latency is None:
+            return None
+        return max(latency, self.hedge_min_delay)
+
+    def _finish(
+        self,
+        endpoint: Optional[Endpoint],
+        error: Optional[BaseException] = None,
+    ) -> None:
+        if endpoint is None:
+            return
+        if isinstance(error, asyncio.CancelledError):
+            failed = None
+        else:
+            failed = error is not None and is_retryable(error)
+        self.balancer.finish(endpoint, failed=failed)
+
+    def _select(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        """Select an endpoint, preferring one that hasn't been tried yet."""
+        if self.balancer is None:
+            return None
+        endpoint = self.balancer.select(exclude=tried)
+        tried.append(endpoint)
+        return endpoint
+
+    async def _open(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        url: StrOrURL,
+        tried: List[Endpoint],
+        **kwargs,
+    ) -> Attempt:
+        """Send the request and return the response once its headers arrived."""
+        endpoint = self._select(tried)
+        if endpoint is not None:
+            url = endpoint.rebase(url)
+            session = endpoint.session or session
+            self.balancer.start(endpoint)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            resp = await session.request(method, url, timeout=self.timeout, **kwargs)
+            latency = loop.time() - start
+            self.latency.observe(latency)
+            if endpoint is not None:
+                self.balancer.observe(endpoint, latency)
+            if resp.status in RETRY_STATUSES:
+                resp.release()
+                resp.raise_for_status()
+        except BaseException as e:
+            self._finish(endpoint, e)
+            raise
+        return Attempt(resp, endpoint)
+
+    async def _open_hedged(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        url: StrOrURL,
+        tried: List[Endpoint],
+        **kwargs,
+    ) -> Attempt:
+        tasks = [
+            asyncio.ensure_future(self._open(session, method, url, tried, **kwargs)),
+        ]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if not done:
+                log.debug("Hedging slow upstream request {url}", extra={"url": url})
+                # the hedge goes to another endpoint if there is one
+                tasks.append(
+                    asyncio.ensure_future(
+                        self._open(session, method, url, tried, **kwargs),
+                    ),
+                )
+
+            pending, error = set(tasks), None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+            if winner is None:
+                raise error
+            return winner
+        finally:
+            # cancel the loser, release its response if it arrived at the same time
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif (
+                    not task.cancelled()
+                    and task.exception() is None
+                    and task.result() is not winner
+                ):
+                    task.result().response.release()
+                    self._finish(task.result().endpoint)
+
+    async def request(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        url: StrOrURL,
+        consume: Callable[[aiohttp.ClientResponse], Awaitable[T]],
+        **kwargs,
+    ) -> T:
+        """
+        Send a request upstream, retrying and hedging it according to the policy.
+
+        With a balancer the request is sent to one of its endpoints (retries
+        prefer another one), otherwise to `url` with `session`.
+
+        :param consume: Coroutine function reading the response. It's part of the
+                        attempt, i. e. errors while reading the body are retried,
+                        too.
+        :param kwargs: Passed on to `ClientSession.request`.
+        """
+        method = method.upper()
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        hedged = method in HEDGED_METHODS and self.hedge_percentile is not None
+        open_attempt = self._open_hedged if hedged else self._open
+        attempt = 0
+        tried: List[Endpoint] = []
+        while True:
+            try:
+                resp, endpoint = await open_attempt(
+                    session,
+                    method,
+                    url,
+                    tried,
+                    **kwargs,
+                )
+                error = None
+                try:
+                    return await consume(resp)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    resp.release()
+                    self._finish(endpoint, error)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= retries or not is_retryable(e):
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                delay *= random.uniform(0.5, 1.0)  # noqa: S311
+                log.warning(
+                    "Retrying {method} {url} in {delay}s: {error}",
+                    extra={"method": method, "url": url, "delay": delay, "error": e},
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
@@ -0,0 +1,222 @@
+import hashlib
+import hmac
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Final, Iterable, List, NamedTuple, Optional
+from urllib.parse import quote
+
+from multidict import CIMultiDict, MultiMapping
+from yarl import URL
+
+ALGORITHM: Final = "AWS4-HMAC-SHA256"
+EMPTY_SHA256: Final = hashlib.sha256(b"").hexdigest()
+UNSIGNED_PAYLOAD: Final = "UNSIGNED-PAYLOAD"
+TIMESTAMP_FORMAT: Final = "%Y%m%dT%H%M%SZ"
+# requests signed longer ago (or ahead) are rejected, like S3 does
+MAX_CLOCK_SKEW: Final = timedelta(minutes=15)
+
+_authorization_re: Final = re.compile(
+    r"^AWS4-HMAC-SHA256\s+"
+    r"Credential=(?P<access_key>[^/,\s]+)/(?P<scope>[^,\s]+),\s*"
+    r"SignedHeaders=(?P<signed_headers>[^,\s]+),\s*"
+    r"Signature=(?P<signature>[0-9a-f]{64})\s*$",
+)
+
+
+class Credential(NamedTuple):
+    access_key: str
+    scope: str
+    signed_headers: str
+    signature: str
+
+    @property
+    def date(self) -> str:
+        return self.scope.split("/")[0]
+
+    @property
+    def region(self) -> str:
+        return self.scope.split("/")[1]
+
+    @property
+    def service(self) -> str:
+        return self.scope.split("/")[2]
+
+
+def parse_authorization(value: Optional[str]) -> Optional[Credential]:
+    """Parse a SigV4 `Authorization` header. Return None if it isn't one."""
+    if not value:
+        return None
+    match = _authorization_re.match(value)
+    if match is None or len(match["scope"].split("/")) != 4:
+        return None
+    return Credential(**match.groupdict())
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def derive_signing_key(secret: str, date: str, region: str, service: str) -> bytes:
+    key = _hmac(f"AWS4{secret}".encode(), date)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    return _hmac(key, "aws4_request")
+
+
+def sign(signing_key: bytes, string_to_sign: str) -> str:
+    return hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+def signatures_match(expected: str, received: str) -> bool:
+    return hmac.compare_digest(expected.encode(), received.encode())
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return quote(value, safe=safe)
+
+
+def canonical_query(query: MultiMapping[str]) -> str:
+    return "&".join(sorted(f"{_quote(k)}={_quote(v)}" for k, v in query.items()))
+
+
+def signed_url(url: URL) -> URL:
+    """Return `url` encoded the way it is signed, so it's sent exactly like that."""
+    return URL.build(
+        scheme=url.scheme,
+        host=url.raw_host,
+        port=url.explicit_port,
+        path=_quote(url.path, safe="/-_.~"),
+        query_string=canonical_query(url.query),
+        encoded=True,
+    )
+
+
+def _canonical_headers(headers: MultiMapping[str], names: List[str]) -> str:
+    return "".join(
+        "{}:{}\n".format(
+            name,
+            ",".join(" ".join(v.split()) for v in headers.getall(name, ())),
+        )
+        for name in names
+    )
+
+
+def _string_to_sign(
+    method: str,
+    url: URL,
+    headers: MultiMapping[str],
+    names: List[str],
+    timestamp: str,
+    scope: str,
+) -> str:
+    canonical_request = "\n".join(
+        [
+            method,
+            _quote(url.path, safe="/-_.~"),
+            canonical_query(url.query),
+            _canonical_headers(headers, names),
+            ";".join(names),
+            headers.get("X-Amz-Content-Sha256", UNSIGNED_PAYLOAD),
+        ],
+    )
+    return "\n".join(
+        [
+            ALGORITHM,
+            timestamp,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ],
+    )
+
+
+def sign_request(
+    method: str,
+    url: URL,
+    headers: CIMultiDict,
+    access_key: str,
+    secret: str,
+    region: str,
+    service: str = "s3",
+    now: Optional[datetime] = None,
+    signed_headers: Optional[Iterable[str]] = None,
+) -> None:
+    """
+    Sign a request on behalf of `access_key`, setting the `Authorization` header.
+
+    `url` must have been passed through `signed_url`.
+
+    :param signed_headers: Names of the headers to sign, all `headers` by default.
+                           `host` and the `x-amz-*` headers are always signed.
+    """
+    now = now or datetime.now(timezone.utc)
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+    date = timestamp[:8]
+    headers.popall("Authorization", None)
+    headers["Host"] = (
+        url.raw_host
+        if url.explicit_port is None
+        else f"{url.raw_host}:{url.explicit_port}"
+    )
+    headers["X-Amz-Date"] = timestamp
+    headers.setdefault("X-Amz-Content-Sha256", UNSIGNED_PAYLOAD)
+
+    names = {name.lower() for name in headers}
+    if signed_headers is not None:
+        names &= {name.lower() for name in signed_headers} | {
+            name for name in names if name == "host" or name.startswith("x-amz-")
+        }
+    names = sorted(names)
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = _string_to_sign(method, url, headers, names, timestamp, scope)
+    signature = sign(derive_signing_key(secret, date, region, service), string_to_sign)
+    headers["Authorization"] = (
+        f"{ALGORITHM} Credential={access_key}/{scope}, "
+        f"SignedHeaders={';'.join(names)}, Signature={signature}"
+    )
+
+
+def verify_request(
+    method: str,
+    url: URL,
+    headers: MultiMapping[str],
+    secret: str,
+    now: Optional[datetime] = None,
+) -> bool:
+    """
+    Verify the `Authorization` header of a received request with `secret`.
+
+    The signature has to cover the `Host` header and must not be older (or newer)
+    than `MAX_CLOCK_SKEW`. The payload hash is taken from `X-Amz-Content-Sha256`
+    as is, verifying it against the body is up to the caller.
+    """
+    credential = parse_authorization(headers.get("Authorization"))
+    timestamp = headers.get("X-Amz-Date", "")
+    if credential is None or not timestamp.startswith(credential.date):
+        return False
+    try:
+        signed_at = datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(
+            tzinfo=timezone.utc,
+        )
+    except ValueError:
+        return False
+    if abs((now or datetime.now(timezone.utc)) - signed_at) > MAX_CLOCK_SKEW:
+        return False
+
+    names = credential.signed_headers.split(";")
+    if "host" not in names:
+        return False
+    string_to_sign = _string_to_sign(
+        method,
+        url,
+        headers,
+        names,
+        timestamp,
+        credential.scope,
+    )
+    signing_key = derive_signing_key(
+        secret,
+        credential.date,
+        credential.region,
+        credential.service,
+    )
+    return signatures_match(sign(signing_key, string_to_sign), credential.signature)
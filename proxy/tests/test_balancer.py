@@ -0,0 +1,92 @@
+import aiohttp
+import pytest
+from aioresponses import aioresponses
+
+from proxy.balancer import LATENCY, Balancer
+from proxy.resilience import Upstream
+
+ENDPOINTS = ["http://minio1:9000", "http://minio2:9000"]
+
+
+def test_balancer_least_outstanding():
+    balancer = Balancer(ENDPOINTS)
+    first = balancer.select()
+    balancer.start(first)
+    second = balancer.select()
+    assert second is not first
+    balancer.start(second)
+    balancer.finish(first, failed=False)
+    assert balancer.select() is first
+
+
+def test_balancer_latency():
+    balancer = Balancer(ENDPOINTS, strategy=LATENCY)
+    slow, fast = balancer.endpoints
+    balancer.observe(slow, 0.5)
+    balancer.observe(fast, 0.1)
+    assert balancer.select() is fast
+    for _ in range(5):
+        balancer.start(fast)
+    assert balancer.select() is slow
+
+
+def test_balancer_ejection(clock):
+    balancer = Balancer(ENDPOINTS, max_failures=2, ejection_time=10, clock=clock)
+    bad, good = balancer.endpoints
+    for _ in range(2):
+        balancer.start(bad)
+        balancer.finish(bad, failed=True)
+    assert all(balancer.select() is good for _ in range(10))
+    assert balancer.stats()[0]["healthy"] is False
+
+    # re-admitted, but ejected twice as long after another failure
+    clock.now = 11
+    assert balancer.select(exclude=[good]) is bad
+    balancer.start(bad)
+    balancer.finish(bad, failed=True)
+    clock.now = 25
+    assert balancer.select(exclude=[good]) is good
+    clock.now = 32
+    balancer.start(bad)
+    balancer.finish(bad, failed=False)
+    assert bad.failures == bad.ejections == 0
+
+    # all endpoints ejected: use the one re-admitted next
+    for endpoint in balancer.endpoints:
+        for _ in range(2):
+            balancer.start(endpoint)
+            balancer.finish(endpoint, failed=True)
+    assert balancer.select() is bad
+
+
+def test_balancer_invalid_strategy():
+    with pytest.raises(ValueError, match="strategy"):
+        Balancer(ENDPOINTS, strategy="random")
+
+
+async def test_upstream_retries_other_endpoint(clock):
+    balancer = Balancer(ENDPOINTS, clock=clock)
+    # make the first endpoint the one selected first
+    balancer.start(balancer.endpoints[1])
+    upstream = Upstream(retries=1, backoff=0, balancer=balancer)
+    await upstream.open()
+
+    async def _read(resp):
+        resp.raise_for_status()
+        return str(resp.url)
+
+    with aioresponses() as m:
+        m.get("http://minio1:9000/bucket/key", status=503)
+        m.get("http://minio2:9000/bucket/key", status=200)
+        async with aiohttp.ClientSession() as session:
+            url = await upstream.request(
+                session,
+                "GET",
+                "http://minio:9000/bucket/key",
+                _read,
+            )
+    await upstream.close()
+
+    assert url == "http://minio2:9000/bucket/key"
+    assert [e["errors"] for e in balancer.stats()] == [1, 0]
+    assert [e["outstanding"] for e in balancer.stats()] == [0, 1]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from proxy.body import Body, BodyAbortedError
+
+
+async def test_body_prefix_before_complete():
+    body = Body()
+    prefix = asyncio.ensure_future(body.prefix(4))
+    body.feed(b"ab")
+    await asyncio.sleep(0)
+    assert not prefix.done()
+    body.feed(b"cdef")
+    assert await prefix == b"abcd"
+
+    full = asyncio.ensure_future(body.read())
+    await asyncio.sleep(0)
+    assert not full.done()
+    body.close()
+    assert await full == b"abcdef"
+    # the complete body is only copied once
+    assert body.getvalue() is await body.read()
+
+
+async def test_body_short_prefix():
+    body = Body()
+    prefix = asyncio.ensure_future(body.prefix(10))
+    body.feed(b"abc")
+    body.close()
+    assert await prefix == b"abc"
+
+
+async def test_body_iter_chunks_from_thread():
+    body = Body()
+    chunks = asyncio.ensure_future(
+        asyncio.to_thread(lambda: list(body.iter_chunks(chunk_size=2))),
+    )
+    for piece in [b"abc", b"d", b"ef"]:
+        body.feed(piece)
+        await asyncio.sleep(0.01)
+    body.close()
+    assert b"".join(await chunks) == b"abcdef"
+
+
+async def test_body_abort():
+    body = Body()
+    waiting = asyncio.ensure_future(body.read())
+    iterating = asyncio.ensure_future(asyncio.to_thread(list, body.iter_chunks()))
+    body.feed(b"abc")
+    await asyncio.sleep(0.01)
+    body.abort(ConnectionResetError())
+    with pytest.raises(BodyAbortedError):
+        await waiting
+    with pytest.raises(BodyAbortedError):
+        await iterating
+    with pytest.raises(BodyAbortedError):
+        body.getvalue()
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from proxy.cache import VerdictCache, verdict_cache
+from proxy.events import Event, on
+
+
+def test_verdict_cache_eviction_and_ttl(clock):
+    cache = VerdictCache(maxsize=2, ttl=10, clock=clock)
+    cache.set(("a", None, None, "1"), (True, None))
+    cache.set(("b", None, None, "1"), (True, None))
+    assert cache.get(("a", None, None, "1")) == (True, None)
+    # "b" is the least recently used entry now
+    cache.set(("c", None, None, "1"), (False, "infected"))
+    assert cache.get(("b", None, None, "1")) is None
+    assert len(cache) == 2
+
+    clock.now = 11
+    assert cache.get(("a", None, None, "1")) is None
+    assert cache.get(("c", None, None, "1")) is None
+    assert len(cache) == 0
+
+
+def test_verdict_cache_invalidate():
+    cache = VerdictCache(maxsize=10, ttl=10)
+    cache.set(("scan", None, None, "1"), (True, None))
+    cache.set(("other", None, None, "1"), (True, None))
+    cache.invalidate("scan")
+    assert cache.get(("scan", None, None, "1")) is None
+    assert cache.get(("other", None, None, "1")) == (True, None)
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize("blocking", [True, False])
+async def test_event_caches_verdicts(s3_file_upload_url, sample_binary, blocking):
+    verdict_cache.invalidate()
+    test_event = Event(blocking=blocking)
+    signatures = {"version": "1"}
+    calls = []
+
+    @on(test_event, cache=True, version=lambda: signatures["version"], version_ttl=0)
+    def scan(request, data=None):
+        calls.append(data)
+        return data != b"EICAR", "scanned"
+
+    @on(test_event)
+    def uncached(request, data=None):
+        calls.append(data)
+        return True, None
+
+    request = make_mocked_request("PUT", str(s3_file_upload_url))
+
+    await test_event(request, sample_binary)
+    result = await test_event(request, sample_binary)
+    assert calls == [sample_binary] * 3
+    assert result[0][1:] == (True, "scanned")
+
+    result = await test_event(request, b"EICAR")
+    assert result[0][1] is False
+    assert len(calls) == 5
+
+    # updated signatures invalidate the previous verdicts
+    signatures["version"] = "2"
+    await test_event(request, sample_binary)
+    assert len(calls) == 7
+
+
+async def test_event_cache_version_ttl(s3_file_upload_url, sample_binary):
+    verdict_cache.invalidate()
+    test_event = Event()
+    threads = []
+
+    def version():
+        threads.append(threading.current_thread())
+        return "1"
+
+    @on(test_event, cache=True, version=version, version_ttl=60)
+    def scan(request, data=None):
+        return True, None
+
+    request = make_mocked_request("PUT", str(s3_file_upload_url))
+    await test_event(request, sample_binary)
+    await test_event(request, b"other")
+
+    # resolved once, outside of the event loop
+    assert len(threads) == 1
+    assert threads[0] is not threading.main_thread()
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from proxy.dispatch import PostUploadQueue, RequestSnapshot
+from proxy.events import post_upload
+
+
+@pytest.fixture
+def upload_request(s3_file_upload_url):
+    return make_mocked_request(
+        "PUT",
+        f"/{s3_file_upload_url}?X-param-1=param-1",
+        headers={"Content-Type": "text/plain", "Authorization": "secret"},
+    )
+
+
+def test_request_snapshot(upload_request):
+    snapshot = RequestSnapshot.loads(
+        RequestSnapshot.from_request(upload_request).dumps(),
+    )
+    assert snapshot.url.path == upload_request.path
+    assert snapshot.query["X-param-1"] == "param-1"
+    assert snapshot.headers["content-type"] == "text/plain"
+    assert "Authorization" not in snapshot.headers
+
+
+async def wait_for_delivery(queue, timeout=5):
+    async def _wait():
+        while (await queue.stats())["depth"]:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(_wait(), timeout)
+
+
+async def test_queue_retries(tmp_path, mocker, upload_request):
+    mocker.patch.object(post_upload, "hooks", [])
+    calls = []
+
+    def webhook(request, data=None):
+        calls.append(request.url.path)
+        return len(calls) > 1, "webhook unreachable"
+
+    post_upload.register_hook(webhook, name="webhook")
+
+    queue = PostUploadQueue(
+        str(tmp_path / "queue.sqlite3"),
+        backoff=0.01,
+        poll_interval=0.01,
+    )
+    await queue.open()
+    try:
+        assert await queue.put(upload_request)
+        await wait_for_delivery(queue)
+        stats = await queue.stats()
+    finally:
+        await queue.close()
+
+    assert calls == [upload_request.path] * 2
+    assert stats["delivered"] == 1
+    assert stats["failed"] == 1
+    assert stats["dead"] == 0
+
+
+async def test_queue_durable_and_bounded(tmp_path, upload_request):
+    path = str(tmp_path / "queue.sqlite3")
+    queue = PostUploadQueue(path, maxsize=1, workers=0)
+    await queue.open()
+    assert await queue.put(upload_request)
+    assert not await queue.put(upload_request)
+    await queue.close()
+
+    queue = PostUploadQueue(path, workers=0)
+    await queue.open()
+    stats = await queue.stats()
+    await queue.close()
+    assert stats["depth"] == 1
+    assert stats["lag"] > 0
+
+
+async def test_queue_prunes_dead_letters(tmp_path, mocker, upload_request):
+    mocker.patch.object(post_upload, "hooks", [])
+    post_upload.register_hook(lambda request, data=None: (False, "down"), name="hook")
+
+    queue = PostUploadQueue(
+        str(tmp_path / "queue.sqlite3"),
+        maxsize=1,
+        max_attempts=1,
+        poll_interval=0.01,
+    )
+    await queue.open()
+    try:
+        for _ in range(2):
+            assert await queue.put(upload_request)
+            await wait_for_delivery(queue)
+        assert (await queue.stats())["dead"] == 2
+
+        # no more than `maxsize` dead letters are kept
+        await queue.prune()
+        assert (await queue.stats())["dead"] == 1
+
+        queue.dead_retention = 0
+        await queue.prune()
+        assert (await queue.stats())["dead"] == 0
+    finally:
+        await queue.close()
+
+
+@pytest.mark.parametrize(
+    "settings,headers,expected_status",
+    [
+        ({"STATS_TOKEN": None}, {"Authorization": "Bearer token"}, 404),
+        ({"STATS_TOKEN": "token"}, {}, 401),
+        ({"STATS_TOKEN": "token"}, {"Authorization": "Bearer other"}, 401),
+        ({"STATS_TOKEN": "token"}, {"Authorization": "Bearer token"}, 200),
+    ],
+    indirect=["settings"],
+)
+async def test_stats(cli, settings, headers, expected_status):
+    resp = await cli.get("/_proxy/stats", headers=headers)
+    assert resp.status == expected_status
+    if expected_status == 200:
+        assert await resp.json() == {}
@@ -1,4 +1,19 @@
-from proxy.ciphers import decrypt, encrypt, generate_key
+import base64
+import hashlib
+
+import pytest
+from cryptography.fernet import InvalidToken
+
+from proxy import ciphers
+from proxy.ciphers import (
+    StreamDecryptor,
+    StreamEncryptor,
+    decrypt,
+    decrypt_with_checksum,
+    encrypt,
+    encrypt_with_checksums,
+    generate_key,
+)
 
 
 def test_key_generation():
@@ -13,3 +28,55 @@ def test_encrypt_decrypt_with_derived_key():
     token = encrypt(object_id, bytestr)
     plain = decrypt(object_id, token)
     assert plain == bytestr
+
+
+@pytest.mark.parametrize("size", [0, 15, 16, 1000])
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_stream_ciphers(size, chunk_size):
+    plain = bytes(range(256)) * 4
+    plain = plain[:size]
+
+    encryptor = StreamEncryptor("test")
+    token = b"".join(
+        encryptor.feed(plain[i : i + chunk_size])
+        for i in range(0, len(plain), chunk_size)
+    )
+    token += encryptor.close()
+    assert decrypt("test", token) == plain
+    assert len(token) == len(encrypt("test", plain))
+
+    token = encrypt("test", plain)
+    decryptor = StreamDecryptor("test")
+    result = b"".join(
+        decryptor.feed(token[i : i + chunk_size])
+        for i in range(0, len(token), chunk_size)
+    )
+    assert result + decryptor.close() == plain
+
+
+def test_stream_decryptor_tampered():
+    token = encrypt("test", b"Very very secret bytes.")
+    decryptor = StreamDecryptor("other")
+    decryptor.feed(token)
+    with pytest.raises(InvalidToken):
+        decryptor.close()
+
+
+@pytest.mark.parametrize("size", [0, 15, 1000])
+def test_encrypt_with_checksums(monkeypatch, size):
+    monkeypatch.setattr(ciphers, "CHECKSUM_CHUNK_SIZE", 64)
+    plain = bytes(range(256)) * 4
+    plain = plain[:size]
+
+    token, checksums = encrypt_with_checksums("test", plain, ["sha256"], ["md5"])
+    assert decrypt("test", token) == plain
+    assert checksums.plaintext == {
+        "sha256": base64.b64encode(hashlib.sha256(plain).digest()).decode(),
+    }
+    assert checksums.ciphertext == {
+        "md5": base64.b64encode(hashlib.md5(token).digest()).decode(),  # noqa: S324
+    }
+
+    decrypted, digest = decrypt_with_checksum("test", token, "sha256")
+    assert decrypted == plain
+    assert digest == checksums.plaintext["sha256"]
@@ -1,11 +1,19 @@
+import asyncio
+import threading
+
 import pytest
+from aiohttp import web
 from aiohttp.test_utils import make_mocked_request
 
+from proxy.body import Body
 from proxy.ciphers import decrypt
 from proxy.events import (
     Event,
+    HookOptions,
     on,
+    post_upload,
     pre_upload_before_check,
+    pre_upload_unsafe,
 )
 
 
@@ -106,3 +114,207 @@ async def test_default_hooks(settings, s3_file_upload_url, sample_binary):
     )
     result = await pre_upload_before_check(request, sample_binary)
     assert decrypt(request.url.name, result[0][2]) == sample_binary
+
+
+@pytest.mark.parametrize("blocking", [True, False])
+async def test_events_match_criteria(sample_binary, blocking):
+    test_event = Event(blocking=blocking)
+
+    @on(test_event)
+    def everywhere(request, data=None):
+        return True, None
+
+    @on(test_event, bucket="invoices", glob="*.pdf")
+    def invoices(request, data=None):
+        return True, None
+
+    @on(test_event, bucket="media", content_type="image/*")
+    def images(request, data=None):
+        return True, None
+
+    @on(test_event, prefix="large/", min_size=len(sample_binary) + 1)
+    def large(request, data=None):
+        return True, None
+
+    async def called(path, content_type):
+        request = make_mocked_request(
+            "PUT",
+            path,
+            headers={"Content-Type": content_type},
+        )
+        return [name for name, _, _ in await test_event(request, sample_binary)]
+
+    assert await called("/invoices/2023.pdf", "application/pdf") == [
+        "everywhere",
+        "invoices",
+    ]
+    assert await called("/invoices/2023.txt", "text/plain") == ["everywhere"]
+    assert await called("/media/cat.png", "image/png; q=1") == [
+        "everywhere",
+        "images",
+    ]
+    assert await called("/invoices/cat.png", "image/png") == ["everywhere"]
+    assert await called("/other/large/file", "text/plain") == ["everywhere"]
+
+    # hooks registered later are indexed, too
+    @on(test_event, bucket="other", max_size=len(sample_binary))
+    def small(request, data=None):
+        return True, None
+
+    assert await called("/other/large/file", "text/plain") == ["everywhere", "small"]
+
+
+@pytest.mark.parametrize("blocking", [True, False])
+async def test_events_data_access(sample_binary, blocking):
+    test_event = Event(blocking=blocking)
+    received = {}
+
+    @on(test_event, data="none")
+    def webhook(request, data=None):
+        received["webhook"] = data
+        return True, None
+
+    @on(test_event, data=4)
+    def sniff(request, data=None):
+        received["sniff"] = data
+        return True, None
+
+    @on(test_event, data="stream")
+    def stream(request, data=None):
+        received["stream"] = b"".join(data)
+        return True, None
+
+    @on(test_event)
+    def full(request, data=None):
+        received["full"] = data
+        return True, None
+
+    request = make_mocked_request("PUT", "/bucket/key")
+    await test_event(request, Body.from_bytes(sample_binary))
+    assert received == {
+        "webhook": None,
+        "sniff": sample_binary[:4],
+        "stream": sample_binary,
+        "full": sample_binary,
+    }
+
+    received.clear()
+    await test_event(request, sample_binary)
+    assert received["sniff"] == sample_binary[:4]
+    assert received["stream"] == sample_binary
+
+
+async def test_events_prefix_hooks_start_early(sample_binary):
+    test_event = Event()
+    sniffed = threading.Event()
+
+    @on(test_event, data=4)
+    def sniff(request, data=None):
+        sniffed.set()
+        return True, data
+
+    @on(test_event)
+    def full(request, data=None):
+        return True, len(data)
+
+    body = Body()
+    request = make_mocked_request("PUT", "/bucket/key")
+    call = asyncio.ensure_future(test_event(request, body))
+    body.feed(sample_binary[:4])
+    assert await asyncio.to_thread(sniffed.wait, 1)
+    assert not call.done()
+
+    body.feed(sample_binary[4:])
+    body.close()
+    assert await call == [
+        ("sniff", True, sample_binary[:4]),
+        ("full", True, len(sample_binary)),
+    ]
+
+
+async def test_events_fail_fast(sample_binary):
+    test_event = Event()
+
+    @on(test_event, data=4)
+    def sniff(request, data=None):
+        return False, "not allowed"
+
+    @on(test_event, data="stream")
+    def stream(request, data=None):
+        return True, b"".join(data)
+
+    body = Body()
+    request = make_mocked_request("PUT", "/bucket/key")
+    call = asyncio.ensure_future(test_event(request, body, fail_fast=True))
+    body.feed(sample_binary)
+    # the streaming hook is cancelled without the body being completed
+    assert await asyncio.wait_for(call, 1) == [("sniff", False, "not allowed")]
+    body.abort(RuntimeError("rejected"))
+
+
+async def test_events_stream_executor(sample_binary):
+    test_event = Event()
+
+    @on(test_event, data="stream")
+    def stream(request, data=None):
+        return True, (threading.current_thread().name, b"".join(data))
+
+    request = make_mocked_request("PUT", "/bucket/key")
+    [(_, _, (thread, data))] = await test_event(
+        request,
+        Body.from_bytes(sample_binary),
+    )
+    assert thread.startswith("stream-hook")
+    assert data == sample_binary
+
+
+async def test_upload_rejected_by_prefix_hook(cli, mocker, s3_file_upload_url):
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hooks",
+        [(0, "sniff", lambda request, data: (False, "not a pdf"))],
+    )
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hook_options",
+        {"sniff": HookOptions(data=4)},
+    )
+    upstream = mocker.patch("proxy.handlers.proxy_pass")
+    stalled = asyncio.Event()
+
+    async def slow_upload():
+        yield b"GIF89a"
+        await stalled.wait()
+        yield b"rest"
+
+    resp = await asyncio.wait_for(
+        cli.put(str(s3_file_upload_url), data=slow_upload()),
+        timeout=2,
+    )
+    # answered without waiting for the rest of the upload
+    assert resp.status == 400
+    assert "not a pdf" in resp.reason
+    upstream.assert_not_called()
+    resp.close()
+
+
+async def test_upload_without_full_hooks_is_not_copied(
+    cli,
+    mocker,
+    s3_file_upload_url,
+    sample_binary,
+):
+    mocker.patch.object(pre_upload_before_check, "hooks", [])
+    mocker.patch.object(pre_upload_unsafe, "hooks", [])
+    mocker.patch.object(post_upload, "hooks", [])
+    getvalue = mocker.spy(Body, "getvalue")
+    upstream = mocker.patch(
+        "proxy.handlers.proxy_pass",
+        return_value=web.Response(status=200),
+    )
+    resp = await cli.put(str(s3_file_upload_url), data=sample_binary)
+    assert resp.status == 200
+    getvalue.assert_not_called()
+    data = upstream.call_args.kwargs["data"]
+    assert isinstance(data, memoryview)
+    assert data == sample_binary
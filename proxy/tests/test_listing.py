@@ -0,0 +1,116 @@
+import re
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+from aioresponses import aioresponses
+
+from proxy.ciphers import encrypt, plaintext_size
+from proxy.listing import SizeRewriter, is_list_request
+
+ENTRY = (
+    "<Contents><Key>key-{i}</Key><ETag>&quot;abc&quot;</ETag>"
+    "<Size>{size}</Size><StorageClass>STANDARD</StorageClass>{meta}</Contents>"
+)
+
+
+def make_listing(sizes, meta=None):
+    entries = "".join(
+        ENTRY.format(
+            i=i,
+            size=size,
+            meta=(
+                "<UserMetadata><X-Amz-Meta-Plaintext-Size>"
+                f"{meta[i]}</X-Amz-Meta-Plaintext-Size></UserMetadata>"
+                if meta
+                else ""
+            ),
+        )
+        for i, size in enumerate(sizes)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        "<Name>bucket</Name><KeyCount>{n}</KeyCount><IsTruncated>true</IsTruncated>"
+        "<NextContinuationToken>1Size2</NextContinuationToken>"
+        f"{entries}</ListBucketResult>"
+    ).encode()
+
+
+def rewrite(rewriter, listing, step):
+    out = b""
+    for i in range(0, len(listing), step):
+        out += rewriter.feed(listing[i : i + step])
+    return out + rewriter.close()
+
+
+def sizes(listing):
+    return [int(s) for s in re.findall(rb"<Size>(\d+)</Size>", listing)]
+
+
+@pytest.mark.parametrize("step", [1, 13, 4096, 10**6])
+def test_size_rewriter(step):
+    plain_sizes = [i * 7 for i in range(1000)]
+    token_sizes = [len(encrypt("key", b"x" * n)) for n in plain_sizes]
+    listing = make_listing(token_sizes)
+
+    rewriter = SizeRewriter(plaintext_size)
+    result = rewrite(rewriter, listing, step)
+    assert sizes(result) == [plaintext_size(s) for s in token_sizes]
+    assert all(0 <= r - p < 16 for r, p in zip(sizes(result), plain_sizes))
+    # everything but the sizes is passed through unchanged
+    assert re.sub(rb"<Size>\d+</Size>", b"", result) == re.sub(
+        rb"<Size>\d+</Size>",
+        b"",
+        listing,
+    )
+
+
+def test_size_rewriter_metadata():
+    listing = make_listing([120, 140], meta=[3, 42])
+    assert sizes(rewrite(SizeRewriter(), listing, 5)) == [3, 42]
+    # unknown sizes are kept without metadata or estimate
+    assert sizes(rewrite(SizeRewriter(), make_listing([120]), 5)) == [120]
+
+
+def test_size_rewriter_bounded():
+    listing = make_listing([120], meta=[3]).replace(b"abc", b"a" * 1000)
+    rewriter = SizeRewriter(max_entry_size=100)
+    assert rewrite(rewriter, listing, 10) == listing
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("/bucket", True),
+        ("/bucket/?list-type=2&continuation-token=abc", True),
+        ("/bucket?versions", True),
+        ("/bucket?location", False),
+        ("/bucket/key", False),
+        ("/", False),
+    ],
+)
+def test_is_list_request(url, expected):
+    assert is_list_request(make_mocked_request("GET", url)) == expected
+
+
+@pytest.mark.usefixtures("_load_default_hooks")
+@pytest.mark.parametrize(
+    "settings,expected_sizes",
+    [
+        ({"LISTING_SIZE_ESTIMATE_ENABLED": False}, [len(encrypt("key", b"x" * 100))]),
+        ({"LISTING_SIZE_ESTIMATE_ENABLED": True}, [111]),
+    ],
+    indirect=["settings"],
+)
+async def test_fetch_listing(cli, s3host_url, settings, expected_sizes):
+    listing = make_listing([len(encrypt("key", b"x" * 100))])
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.get(
+            re.compile(rf"^{s3host_url}/bucket.*$"),
+            body=listing,
+            content_type="application/xml",
+        )
+        resp = await cli.get("/bucket", params={"list-type": "2"})
+        assert resp.status == 200
+        assert resp.content_type == "application/xml"
+        assert sizes(await resp.read()) == expected_sizes
@@ -1,16 +1,28 @@
 import asyncio
+import base64
+import hashlib
 import re
 
 import aiohttp
 import pytest
 from aiohttp import web
-from aioresponses import aioresponses
+from aioresponses import CallbackResult, aioresponses
+from multidict import CIMultiDict, CIMultiDictProxy
 from pytest_lazyfixture import lazy_fixture
 from requests.status_codes import codes as http_codes
 
+from proxy import sigv4
+from proxy.checksums import PLAINTEXT_CHECKSUM_HEADER, b64digest, new_hasher
 from proxy.conf import settings
 from proxy.conftest import MockRequest
-from proxy.events import post_upload, pre_upload_before_check, pre_upload_unsafe
+from proxy.default_hooks import hook_decrypt_data, hook_encrypt_data
+from proxy.events import (
+    post_retrieve_data,
+    post_upload,
+    pre_upload_before_check,
+    pre_upload_unsafe,
+)
+from proxy.handlers import to_response
 
 match_bucket_key_params = r"(?P<bucket>[^/]+)/(?P<key>[^/\?]+)/?\??(?P<params>(.*)?)$"
 match_bucket_only = r"(?P<bucket>[^/\?]+)/?\??(?P<params>(.*)?)$"
@@ -212,3 +224,340 @@ async def test_fetch(
 async def test_settings(settings, cli):
     resp = await cli.post("/")
     assert resp.status == 405
+
+
+@pytest.mark.usefixtures("_load_default_hooks")
+@pytest.mark.parametrize(
+    "urls,headers,expected_upstream_calls,expected_authorizations",
+    [
+        ([""] * 3, [{}, {}, {}], 1, 2),
+        ([""] * 3, [{"Range": "bytes=0-1"}, {"Range": "bytes=0-1"}, {}], 2, 1),
+        ([""] * 3, [{"Authorization": "a"}, {"Authorization": "b"}, {}], 1, 2),
+        (
+            ["?X-Amz-Signature=a", "?X-Amz-Signature=b", "?versionId=1"],
+            [{}, {}, {}],
+            2,
+            1,
+        ),
+    ],
+)
+async def test_fetch_coalesced(
+    cli,
+    mocker,
+    s3_file_upload_url,
+    sample_token,
+    sample_binary,
+    urls,
+    headers,
+    expected_upstream_calls,
+    expected_authorizations,
+):
+    async def slow_proxy_pass(request):
+        await asyncio.sleep(0.05)
+        return web.Response(status=http_codes.ok, body=sample_token)
+
+    upstream = mocker.patch("proxy.handlers.proxy_pass", side_effect=slow_proxy_pass)
+    authorize = mocker.patch("proxy.handlers.authorize", return_value=None)
+    responses = await asyncio.gather(
+        *[
+            cli.get(f"/{s3_file_upload_url}{url}", headers=h)
+            for url, h in zip(urls, headers)
+        ],
+    )
+    assert [r.status for r in responses] == [http_codes.ok] * len(headers)
+    assert [await r.read() for r in responses] == [sample_binary] * len(headers)
+    assert upstream.call_count == expected_upstream_calls
+    assert authorize.call_count == expected_authorizations
+
+
+@pytest.mark.usefixtures("_load_default_hooks")
+async def test_fetch_coalesced_denied(
+    cli,
+    mocker,
+    s3host_url,
+    s3_file_upload_url,
+    sample_token,
+):
+    async def slow_proxy_pass(request):
+        await asyncio.sleep(0.05)
+        return web.Response(status=http_codes.ok, body=sample_token)
+
+    mocker.patch("proxy.handlers.proxy_pass", side_effect=slow_proxy_pass)
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.get(re.compile(rf"^{s3host_url}/.*$"), status=http_codes.forbidden)
+        allowed, denied = await asyncio.gather(
+            cli.get(str(s3_file_upload_url), headers={"Authorization": "a"}),
+            cli.get(str(s3_file_upload_url), headers={"Authorization": "b"}),
+        )
+        assert allowed.status == http_codes.ok
+        assert denied.status == http_codes.forbidden
+
+        # the joining client's own request, limited to the first byte
+        [((_, upstream_url), [(_, req_kwargs)])] = m.requests.items()
+        assert upstream_url.path == f"/{s3_file_upload_url}"
+        assert req_kwargs["headers"]["Authorization"] == "b"
+        assert req_kwargs["headers"]["Range"] == "bytes=0-0"
+
+
+@pytest.mark.usefixtures("_load_default_hooks")
+async def test_fetch_coalesced_denied_leader(
+    cli,
+    s3host_url,
+    s3_file_upload_url,
+    sample_token,
+    sample_binary,
+):
+    calls = []
+
+    async def _callback(url, headers=None, **kwargs):
+        calls.append((headers["Authorization"], headers.get("Range")))
+        if headers["Authorization"] == "denied":
+            await asyncio.sleep(0.05)
+            return CallbackResult(status=http_codes.forbidden, reason="Forbidden")
+        return CallbackResult(status=http_codes.ok, body=sample_token)
+
+    async def follower():
+        # join the fetch started by the denied client
+        await asyncio.sleep(0.01)
+        return await cli.get(
+            str(s3_file_upload_url),
+            headers={"Authorization": "allowed"},
+        )
+
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.get(re.compile(rf"^{s3host_url}/.*$"), callback=_callback, repeat=True)
+        denied, allowed = await asyncio.gather(
+            cli.get(str(s3_file_upload_url), headers={"Authorization": "denied"}),
+            follower(),
+        )
+        assert denied.status != http_codes.ok
+        assert allowed.status == http_codes.ok
+        assert await allowed.read() == sample_binary
+
+    # authorized on its own, then fetched for itself
+    assert calls == [
+        ("denied", None),
+        ("allowed", "bytes=0-0"),
+        ("allowed", None),
+    ]
+
+
+def md5(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode()  # noqa: S324
+
+
+@pytest.mark.parametrize("valid", [True, False])
+async def test_upload_checksums(cli, mocker, s3_file_upload_url, sample_binary, valid):
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hooks",
+        [(0, "hook_encrypt_data", hook_encrypt_data)],
+    )
+    mocker.patch.object(pre_upload_unsafe, "hooks", [])
+    mocker.patch.object(post_upload, "hooks", [])
+    upstream = mocker.patch(
+        "proxy.handlers.proxy_pass",
+        return_value=web.Response(status=http_codes.ok),
+    )
+    resp = await cli.put(
+        str(s3_file_upload_url),
+        headers={"Content-MD5": md5(sample_binary if valid else b"other")},
+        data=sample_binary,
+    )
+    if not valid:
+        assert resp.status == http_codes.bad_request
+        upstream.assert_not_called()
+        return
+
+    assert resp.status == http_codes.ok
+    data, headers = (
+        upstream.call_args.kwargs["data"],
+        upstream.call_args.kwargs["headers"],
+    )
+    # upstream verifies the ciphertext, the plaintext checksum is kept as metadata
+    assert headers["Content-MD5"] == md5(data)
+    assert headers[PLAINTEXT_CHECKSUM_HEADER] == f"md5:{md5(sample_binary)}"
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"X-Amz-Checksum-Crc32c": "AAAAAA=="},
+        {"X-Amz-Sdk-Checksum-Algorithm": "CRC64NVME"},
+        {"X-Amz-Trailer": "x-amz-checksum-crc32c"},
+    ],
+)
+async def test_upload_unsupported_checksum(
+    cli,
+    mocker,
+    s3_file_upload_url,
+    sample_binary,
+    headers,
+):
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hooks",
+        [(0, "hook_encrypt_data", hook_encrypt_data)],
+    )
+    upstream = mocker.patch("proxy.handlers.proxy_pass")
+    resp = await cli.put(str(s3_file_upload_url), headers=headers, data=sample_binary)
+    assert resp.status == http_codes.bad_request
+    assert "not supported" in resp.reason
+    upstream.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{"CLIENT_CREDENTIALS": {"AKIAEXAMPLE": "secret"}}],
+    indirect=True,
+)
+@pytest.mark.usefixtures("settings")
+async def test_upload_checksums_signed(
+    cli,
+    mocker,
+    s3host_url,
+    s3_file_upload_url,
+    sample_binary,
+):
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hooks",
+        [(0, "hook_encrypt_data", hook_encrypt_data)],
+    )
+    mocker.patch.object(pre_upload_unsafe, "hooks", [])
+    mocker.patch.object(post_upload, "hooks", [])
+    crc32 = new_hasher("crc32")
+    crc32.update(sample_binary)
+    headers = CIMultiDict(
+        {
+            "Content-MD5": md5(sample_binary),
+            "X-Amz-Checksum-Crc32": b64digest(crc32),
+            "X-Amz-Sdk-Checksum-Algorithm": "CRC32",
+            "X-Amz-Content-Sha256": hashlib.sha256(sample_binary).hexdigest(),
+        },
+    )
+    url = sigv4.signed_url(cli.make_url(f"/{s3_file_upload_url}"))
+    sigv4.sign_request("PUT", url, headers, "AKIAEXAMPLE", "secret", "eu")
+
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.put(re.compile(rf"^{s3host_url}/.*$"), status=http_codes.ok)
+        resp = await cli.put(
+            str(s3_file_upload_url),
+            headers=headers,
+            data=sample_binary,
+        )
+        assert resp.status == http_codes.ok
+        [((_, upstream_url), [(_, req_kwargs)])] = m.requests.items()
+
+    data, forwarded = req_kwargs["data"], CIMultiDictProxy(req_kwargs["headers"])
+    crc32 = new_hasher("crc32")
+    crc32.update(data)
+    assert forwarded["Content-MD5"] == md5(data)
+    assert forwarded["X-Amz-Checksum-Crc32"] == b64digest(crc32)
+    assert "X-Amz-Sdk-Checksum-Algorithm" not in forwarded
+    assert forwarded["X-Amz-Content-Sha256"] == "UNSIGNED-PAYLOAD"
+    # the changed checksums and the metadata are signed for the client
+    assert "x-amz-meta-plaintext-checksum" in forwarded["Authorization"]
+    assert sigv4.verify_request("PUT", upstream_url, forwarded, "secret")
+
+
+async def test_upload_signed_unknown_client(
+    cli,
+    mocker,
+    s3host_url,
+    s3_file_upload_url,
+    sample_binary,
+):
+    mocker.patch.object(
+        pre_upload_before_check,
+        "hooks",
+        [(0, "hook_encrypt_data", hook_encrypt_data)],
+    )
+    mocker.patch.object(pre_upload_unsafe, "hooks", [])
+    mocker.patch.object(post_upload, "hooks", [])
+    headers = CIMultiDict({"X-Amz-Content-Sha256": "UNSIGNED-PAYLOAD"})
+    url = sigv4.signed_url(cli.make_url(f"/{s3_file_upload_url}"))
+    sigv4.sign_request("PUT", url, headers, "AKIAUNKNOWN", "secret", "eu")
+    authorization = headers["Authorization"]
+    # not signed by the client, so the proxy may drop it
+    headers["Content-MD5"] = md5(sample_binary)
+
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.put(re.compile(rf"^{s3host_url}/.*$"), status=http_codes.ok)
+        resp = await cli.put(
+            str(s3_file_upload_url),
+            headers=headers,
+            data=sample_binary,
+        )
+        assert resp.status == http_codes.ok
+        [((_, upstream_url), [(_, req_kwargs)])] = m.requests.items()
+
+    # the encrypted body is passed on with the client's own signature
+    forwarded = CIMultiDictProxy(req_kwargs["headers"])
+    assert req_kwargs["data"] != sample_binary
+    assert forwarded["Authorization"] == authorization
+    assert "Content-MD5" not in forwarded
+    assert not [h for h in forwarded if h.lower().startswith("x-amz-meta-")]
+    assert sigv4.verify_request("PUT", upstream_url, forwarded, "secret")
+
+
+@pytest.mark.parametrize(
+    "stored_checksum,expected_status",
+    [
+        (None, http_codes.ok),
+        ("md5:{}", http_codes.ok),
+        ("md5:AAAAAAAAAAAAAAAAAAAAAA==", http_codes.bad_request),
+    ],
+)
+async def test_fetch_verifies_checksum(
+    cli,
+    mocker,
+    s3_file_upload_url,
+    sample_binary,
+    sample_token,
+    stored_checksum,
+    expected_status,
+):
+    mocker.patch.object(
+        post_retrieve_data,
+        "hooks",
+        [(0, "hook_decrypt_data", hook_decrypt_data)],
+    )
+    headers = {}
+    if stored_checksum:
+        headers[PLAINTEXT_CHECKSUM_HEADER] = stored_checksum.format(md5(sample_binary))
+    mocker.patch(
+        "proxy.handlers.proxy_pass",
+        return_value=web.Response(
+            status=http_codes.ok,
+            body=sample_token,
+            headers=headers,
+        ),
+    )
+    resp = await cli.get(str(s3_file_upload_url))
+    assert resp.status == expected_status
+
+
+def test_to_response_filters_headers(mocker):
+    client_resp = mocker.Mock(
+        status=http_codes.ok,
+        reason="OK",
+        headers=CIMultiDictProxy(
+            CIMultiDict(
+                {
+                    "accept": "text/plain",
+                    "X-Amz-Meta-Plaintext-Checksum": "crc32:AAAAAA==",
+                    "Server": "upstream",
+                    "Content-Length": "10",
+                },
+            ),
+        ),
+    )
+    body = b"content"
+    response = to_response(client_resp, content=body)
+    assert dict(response.headers) == {
+        "accept": "text/plain",
+        "X-Amz-Meta-Plaintext-Checksum": "crc32:AAAAAA==",
+    }
+    # the content is passed on without copying it
+    assert response.body is body
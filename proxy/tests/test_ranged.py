@@ -0,0 +1,137 @@
+import re
+
+import aiohttp
+import pytest
+from aioresponses import CallbackResult, aioresponses
+
+from proxy.checksums import PLAINTEXT_CHECKSUM_HEADER
+from proxy.conf import settings
+from proxy.ranged import fetch_ranged, open_ranged, parse_content_range, split_ranges
+from proxy.resilience import Upstream
+
+
+def serve_ranges(blob, calls, extra_headers=None):
+    def _callback(url, headers=None, **kwargs):
+        calls.append(headers.get("Range"))
+        if "Range" not in headers:
+            return CallbackResult(status=200, body=blob, headers={"ETag": "abc"})
+        start, end = map(int, headers["Range"][len("bytes=") :].split("-"))
+        if start >= len(blob):
+            return CallbackResult(status=416)
+        end = min(end, len(blob) - 1)
+        return CallbackResult(
+            status=206,
+            body=blob[start : end + 1],
+            headers={
+                "Content-Range": f"bytes {start}-{end}/{len(blob)}",
+                "ETag": "abc",
+                **(extra_headers or {}),
+            },
+        )
+
+    return _callback
+
+
+ranged_settings = pytest.mark.parametrize(
+    "settings",
+    [
+        {
+            "RANGED_FETCH_ENABLED": True,
+            "RANGED_FETCH_PART_SIZE": 10,
+            "RANGED_FETCH_THRESHOLD": 30,
+            "RANGED_FETCH_CONCURRENCY": 2,
+        },
+    ],
+    indirect=True,
+)
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 0-9/100") == (0, 9, 100)
+    assert parse_content_range("bytes */100") is None
+    assert parse_content_range(None) is None
+
+
+def test_split_ranges():
+    assert split_ranges(10, 35, 10) == [(10, 19), (20, 29), (30, 34)]
+
+
+@ranged_settings
+@pytest.mark.usefixtures("settings")
+@pytest.mark.parametrize(
+    "size,expected_ranges",
+    [
+        (0, ["bytes=0-9", None]),
+        (5, ["bytes=0-9"]),
+        (25, ["bytes=0-9", "bytes=10-24"]),
+        (45, ["bytes=0-9", "bytes=10-19", "bytes=20-29", "bytes=30-39", "bytes=40-44"]),
+    ],
+)
+async def test_fetch_ranged(s3host_url, size, expected_ranges):
+    blob = bytes(range(256))[:size]
+    calls = []
+    url = f"{s3host_url}/bucket/key"
+    with aioresponses() as m:
+        m.get(url, callback=serve_ranges(blob, calls), repeat=True)
+        async with aiohttp.ClientSession() as session:
+            _, content = await fetch_ranged(Upstream(), session, url, {}, {})
+    assert content == blob
+    assert sorted(calls, key=str) == sorted(expected_ranges, key=str)
+
+
+@ranged_settings
+@pytest.mark.usefixtures("settings", "_load_default_hooks")
+async def test_fetch_ranged_object(cli, s3host_url, s3_file_upload_url, sample_token):
+    calls = []
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.get(
+            re.compile(rf"^{s3host_url}/{s3_file_upload_url}$"),
+            callback=serve_ranges(sample_token, calls),
+            repeat=True,
+        )
+        resp = await cli.get(str(s3_file_upload_url))
+        assert resp.status == 200
+        assert await resp.read() == b"You can read binary?"
+    assert len(calls) > 3
+
+
+@ranged_settings
+@pytest.mark.usefixtures("settings")
+async def test_open_ranged_fetches_ahead(s3host_url):
+    blob = bytes(range(256))[:95]
+    calls = []
+    url = f"{s3host_url}/bucket/key"
+    with aioresponses() as m:
+        m.get(url, callback=serve_ranges(blob, calls), repeat=True)
+        async with aiohttp.ClientSession() as session:
+            _, parts = await open_ranged(Upstream(), session, url, {}, {})
+            assert await parts.__anext__() == blob[:10]
+            assert await parts.__anext__() == blob[10:20]
+            await parts.aclose()
+    # the first range and no more than the concurrency ahead of the consumer
+    assert len(calls) <= 1 + 1 + settings.RANGED_FETCH_CONCURRENCY
+
+
+@ranged_settings
+@pytest.mark.usefixtures("settings", "_load_default_hooks")
+async def test_fetch_ranged_object_checksum_mismatch(
+    cli,
+    s3host_url,
+    s3_file_upload_url,
+    sample_token,
+):
+    with aioresponses(passthrough=["http://127.0.0.1"]) as m:
+        m.get(
+            re.compile(rf"^{s3host_url}/{s3_file_upload_url}$"),
+            callback=serve_ranges(
+                sample_token,
+                [],
+                {PLAINTEXT_CHECKSUM_HEADER: "crc32:AAAAAA=="},
+            ),
+            repeat=True,
+        )
+        resp = await cli.get(str(s3_file_upload_url))
+        assert resp.status == 200
+        # the download is aborted instead of completed
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await resp.read()
@@ -0,0 +1,83 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aioresponses import CallbackResult, aioresponses
+from yarl import URL
+
+from proxy.resilience import LatencyTracker, Upstream
+
+OBJECT_URL = "http://upstream/bucket/key"
+
+
+async def _read(resp):
+    resp.raise_for_status()
+    return await resp.read()
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(min_samples=3)
+    tracker.observe(1.0)
+    tracker.observe(2.0)
+    assert tracker.percentile(50) is None
+    tracker.observe(3.0)
+    assert tracker.percentile(50) == 2.0
+    assert tracker.percentile(100) == 3.0
+
+
+async def test_retry_on_server_error():
+    upstream = Upstream(retries=2, backoff=0)
+    with aioresponses() as mocked:
+        mocked.get(OBJECT_URL, status=503)
+        mocked.get(OBJECT_URL, status=200, body=b"ok")
+        async with aiohttp.ClientSession() as session:
+            assert await upstream.request(session, "GET", OBJECT_URL, _read) == b"ok"
+
+
+async def test_retries_exhausted():
+    upstream = Upstream(retries=1, backoff=0)
+    with aioresponses() as mocked:
+        mocked.get(OBJECT_URL, status=503, repeat=True)
+        async with aiohttp.ClientSession() as session:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await upstream.request(session, "GET", OBJECT_URL, _read)
+        assert len(mocked.requests[("GET", URL(OBJECT_URL))]) == 2
+
+
+@pytest.mark.parametrize(
+    "method,status",
+    [("POST", 503), ("GET", 404)],
+)
+async def test_no_retry(method, status):
+    upstream = Upstream(retries=2, backoff=0)
+    with aioresponses() as mocked:
+        mocked.add(OBJECT_URL, method, status=status, repeat=True)
+        async with aiohttp.ClientSession() as session:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await upstream.request(session, method, OBJECT_URL, _read)
+        assert len(mocked.requests[(method, URL(OBJECT_URL))]) == 1
+
+
+def test_hedging_off_by_default():
+    assert Upstream.from_settings().hedge_percentile is None
+
+
+async def test_hedge_slow_request():
+    upstream = Upstream(retries=0, hedge_percentile=95)
+    for _ in range(upstream.latency.min_samples):
+        upstream.latency.observe(0.01)
+
+    calls = []
+
+    async def _callback(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+            return CallbackResult(status=200, body=b"slow")
+        return CallbackResult(status=200, body=b"fast")
+
+    with aioresponses() as mocked:
+        mocked.get(OBJECT_URL, callback=_callback, repeat=True)
+        async with aiohttp.ClientSession() as session:
+            assert await upstream.request(session, "GET", OBJECT_URL, _read) == b"fast"
+    assert len(calls) == 2
@@ -29,7 +29,7 @@ def make_error_response(results: List[Union[str, bool]], reason: str, status_cod
     msg = ", ".join(
         [
             f"<{name}> : {result}"
-            for name, success, result in results
+            for name, success, result, *_ in results
             if success is False
         ],
     )